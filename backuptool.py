@@ -7,150 +7,2872 @@ import sys
 import hashlib
 import datetime
 import shutil
+import itertools
+import queue
+import threading
+import functools
+import re
+import zlib
+import bz2
+import lzma
+import mmap
+import errno
+import stat
+import tempfile
+
+try:
+    import fcntl
+except ImportError:  # not available on Windows
+    fcntl = None
+
+# Files are read, hashed and stored in pieces of this size, so memory use during a
+# snapshot does not depend on file size. Larger files are stored as a list of pieces.
+CHUNK_SIZE = 4 * 1024 * 1024
+
+# Content-defined chunking finds cut points with a per-byte loop in Python, which runs
+# at about 6 MB/s per reader thread (hashing alone runs at over 1 GB/s). Files smaller
+# than this are split into fixed pieces even when a chunker is given.
+CDC_MIN_FILE_SIZE = 64 * 1024 * 1024
+
+# Default number of reader/hasher threads used by snapshot.
+DEFAULT_JOBS = min(8, os.cpu_count() or 1)
+
+# A snapshot commits after buffering this many rows or this many bytes of new content,
+# whichever comes first.
+COMMIT_ROWS = 10000
+COMMIT_BYTES = 64 * 1024 * 1024
+
+# Current database schema version, stored in PRAGMA user_version. v1 keyed blobs by
+# 64-character hex TEXT; v2 uses the 32-byte binary SHA-256 digest; v3 stores each
+# file path once in dirs/paths and refers to it by id from entries; v4 stores new
+# snapshots as content-addressed directory trees; in v5 every snapshot is a tree, so
+# a snapshot is a single row however many files it has.
+SCHEMA_VERSION = 5
+
+# Rows converted per transaction by migrate.
+MIGRATE_BATCH = 5000
+
+# Pack files of the "pack" storage backend are filled up to this size before a new one
+# is started; read-only maps of at most MAX_OPEN_PACKS of them are kept open by restore.
+PACK_SIZE = 512 * 1024 * 1024
+MAX_OPEN_PACKS = 64
+
+# With the "pack" and "object" storage backends, stored blobs smaller than this stay
+# inline in the blobs table; larger ones are placed outside the database.
+INLINE_THRESHOLD = 64 * 1024
+
+# With delta encoding, a changed file is stored as a delta against its previous version
+# if that is at most DELTA_RATIO of the size of storing it in full. Chains are at most
+# MAX_DELTA_DEPTH deltas long; the next version is stored in full again.
+DELTA_RATIO = 0.5
+MAX_DELTA_DEPTH = 8
+
+# A sharded repository splits blob storage across this many database files at most,
+# which keeps the catalog connection within SQLite's default limit of 10 attached
+# databases.
+MAX_SHARDS = 8
+
+# Restore holds at most this many bytes of stored content read from the database and
+# not yet written by its writer threads.
+RESTORE_BUFFER_BYTES = 256 * 1024 * 1024
+
+# ioctl request that makes a file share the extents of another (Linux FICLONE), used
+# by restore --dedup=reflink on filesystems such as btrfs and XFS.
+FICLONE = 0x40049409
+
+# Repositories with up to this many blobs get an exact in-memory set of known hashes
+# during a snapshot; larger ones get a Bloom filter backed by database lookups.
+KNOWN_SET_LIMIT = 2000000
+
+# ----------------------------
+# Content-defined chunking
+# ----------------------------
+# Gear table for the rolling hash: 256 fixed pseudo-random 64-bit values. It must never
+# change, or chunk boundaries (and therefore deduplication) would differ between runs.
+_GEAR = [int.from_bytes(hashlib.sha256(bytes([i])).digest()[:8], "big") for i in range(256)]
+
+
+class FastCDC:
+    """
+    FastCDC-style content-defined chunker.
+
+    Cut points are chosen where a gear rolling hash over the preceding bytes matches a
+    mask, so an insertion or deletion only changes the chunks around it. Normalized
+    chunking uses a stricter mask before avg_size and a looser one after it, which keeps
+    chunk sizes close to avg_size. Chunks are never shorter than min_size (except at
+    the end of the data) nor longer than max_size.
+
+    Finding cut points is slow in pure Python (see CDC_MIN_FILE_SIZE), so files
+    smaller than min_file_size are split into fixed CHUNK_SIZE pieces instead.
+    """
+
+    def __init__(self, min_size=256 * 1024, avg_size=1024 * 1024, max_size=CHUNK_SIZE,
+                 min_file_size=CDC_MIN_FILE_SIZE):
+        if not 0 < min_size < avg_size < max_size:
+            raise ValueError("chunk sizes must satisfy 0 < min < avg < max")
+        self.min_size = min_size
+        self.avg_size = avg_size
+        self.max_size = max_size
+        self.min_file_size = min_file_size
+        bits = max(avg_size.bit_length() - 1, 3)
+        self.mask_s = self._mask(bits + 2)
+        self.mask_l = self._mask(bits - 2)
+
+    @staticmethod
+    def _mask(bits):
+        # Test the high bits, which depend on the last 64 bytes fed into the hash.
+        return ((1 << bits) - 1) << (64 - bits)
+
+    def split(self, f):
+        """Yields successive chunks of an open binary file, buffering at most 2 * max_size bytes."""
+        if os.fstat(f.fileno()).st_size < self.min_file_size:
+            yield from iter(lambda: f.read(CHUNK_SIZE), b"")
+            return
+        buf = b""
+        eof = False
+        while True:
+            while not eof and len(buf) < self.max_size:
+                data = f.read(self.max_size)
+                if not data:
+                    eof = True
+                buf += data
+            if not buf:
+                return
+            cut = self._cut_point(memoryview(buf))
+            yield buf[:cut]
+            buf = buf[cut:]
+
+    def _cut_point(self, data):
+        """Returns the length of the first chunk in data."""
+        n = len(data)
+        if n <= self.min_size:
+            return n
+        end = min(n, self.max_size)
+        normal = min(end, self.avg_size)
+        gear = _GEAR
+        fp = 0
+        mask = self.mask_s
+        for i, b in enumerate(data[self.min_size:normal], self.min_size):
+            fp = ((fp << 1) + gear[b]) & 0xFFFFFFFFFFFFFFFF
+            if not fp & mask:
+                return i + 1
+        mask = self.mask_l
+        for i, b in enumerate(data[normal:end], normal):
+            fp = ((fp << 1) + gear[b]) & 0xFFFFFFFFFFFFFFFF
+            if not fp & mask:
+                return i + 1
+        return end
+
+# ----------------------------
+# Compression
+# ----------------------------
+# Restore writes content in pieces of at most this size: compressed content is
+# decompressed incrementally, and inline content larger than this is read straight
+# from the database by the writer threads.
+STREAM_CHUNK = 1024 * 1024
+
+
+def _zlib_stream(chunks):
+    d = zlib.decompressobj()
+    for data in chunks:
+        while data:
+            yield d.decompress(data, STREAM_CHUNK)
+            data = d.unconsumed_tail
+    yield d.flush()
+
+
+def _decompressor_stream(factory):
+    def stream(chunks):
+        d = factory()
+        for data in chunks:
+            while not d.eof:
+                yield d.decompress(data, STREAM_CHUNK)
+                data = b""
+                if d.needs_input:
+                    break
+    return stream
+
+
+# Codec name -> (compress(data, level), decompress(data), default level, valid levels,
+# stream(chunks)), where stream decompresses content given as an iterable of chunks
+# and yields it in pieces of at most STREAM_CHUNK bytes. Blobs stored without
+# compression have a NULL codec.
+CODECS = {
+    "zlib": (lambda data, level: zlib.compress(data, level), zlib.decompress, 6, range(0, 10), _zlib_stream),
+    "bz2": (lambda data, level: bz2.compress(data, level), bz2.decompress, 9, range(1, 10),
+            _decompressor_stream(bz2.BZ2Decompressor)),
+    "lzma": (lambda data, level: lzma.compress(data, preset=level), lzma.decompress, 6, range(0, 10),
+             _decompressor_stream(lzma.LZMADecompressor)),
+}
+
+# Content smaller than this is never compressed, and at most this much of a blob is
+# test-compressed to decide whether compressing the whole blob is worthwhile.
+COMPRESS_MIN_SIZE = 256
+COMPRESS_PROBE_SIZE = 64 * 1024
+
+
+def _compress(content, codec, level=None):
+    """
+    Returns (stored_content, codec) for a blob. Before compressing, a sample from the
+    middle of the content is compressed with fast zlib; if that saves less than 10%,
+    the data (JPEG, archives, already-compressed files) is stored raw with a NULL
+    codec. Compressed output that is not smaller than the input is also stored raw.
+    """
+    if codec is None or len(content) < COMPRESS_MIN_SIZE:
+        return content, None
+    start = max(0, (len(content) - COMPRESS_PROBE_SIZE) // 2)
+    sample = content[start:start + COMPRESS_PROBE_SIZE]
+    if len(zlib.compress(sample, 1)) > len(sample) * 0.9:
+        return content, None
+    compress, _, default_level, _, _ = CODECS[codec]
+    packed = compress(content, default_level if level is None else level)
+    if len(packed) >= len(content):
+        return content, None
+    return packed, codec
+
+
+def _decompress(stored, codec):
+    """Returns the original content of a blob stored with the given codec."""
+    if codec is None:
+        return stored
+    return CODECS[codec][1](stored)
+
+
+def _slices(buf):
+    """Yields zero-copy views of buf of at most STREAM_CHUNK bytes."""
+    view = memoryview(buf)
+    return (view[i:i + STREAM_CHUNK] for i in range(0, len(view), STREAM_CHUNK))
+
+
+def _write_chunks(f, chunks, codec):
+    """Writes content stored with codec, given as an iterable of chunks, to f."""
+    if codec is not None:
+        chunks = CODECS[codec][4](chunks)
+    for chunk in chunks:
+        f.write(chunk)
+
+# ----------------------------
+# Delta encoding
+# ----------------------------
+# A delta is a sequence of operations, each starting with a varint n: if n is odd, the
+# next varint is an offset and n >> 1 bytes are copied from that offset of the base;
+# if n is even, the n >> 1 literal bytes that follow are inserted.
+DELTA_BLOCK = 32
+
+# Before scanning a whole target, _make_delta looks for matches at this many evenly
+# spaced places in it, so that a file unrelated to its base is rejected quickly.
+DELTA_SAMPLES = 64
+
+
+def _varint(n):
+    out = bytearray()
+    while n >= 0x80:
+        out.append(n & 0x7F | 0x80)
+        n >>= 7
+    out.append(n)
+    return out
+
+
+def _read_varint(data, pos):
+    n = shift = 0
+    while True:
+        b = data[pos]
+        pos += 1
+        n |= (b & 0x7F) << shift
+        if b < 0x80:
+            return n, pos
+        shift += 7
+
+
+def _match_length(a, a_pos, b, b_pos):
+    """Returns the length of the common prefix of a[a_pos:] and b[b_pos:]."""
+    n = min(len(a) - a_pos, len(b) - b_pos)
+    length, step = 0, 4096
+    while step:
+        k = min(step, n - length)
+        if k and a[a_pos + length:a_pos + length + k] == b[b_pos + length:b_pos + length + k]:
+            length += k
+        else:
+            step //= 2
+    return length
+
+
+def _delta_sample_matches(index, target, limit):
+    """
+    Returns whether enough sampled windows of target contain a block of the base
+    indexed in index for a delta of at most limit bytes to be likely. Copied regions
+    must cover at least 1 - limit / len(target) of target; half of that share of
+    the windows is required, which leaves room for sampling error.
+    """
+    end = len(target) - DELTA_BLOCK
+    if end < 0 or limit >= len(target):
+        return True
+    starts = range(0, end + 1, max((end + 1) // DELTA_SAMPLES, 1))
+    hits = sum(
+        any(target[pos:pos + DELTA_BLOCK] in index for pos in range(start, min(start + DELTA_BLOCK, end + 1)))
+        for start in starts
+    )
+    return hits >= len(starts) * (1 - limit / len(target)) / 2
+
+
+def _make_delta(base, target, limit):
+    """
+    Returns a delta that turns base into target, or None if it would be longer than
+    limit bytes. DELTA_BLOCK-byte blocks of the base are indexed at block boundaries,
+    and target is scanned byte by byte for them, so matches are found at any offset;
+    each match is extended in both directions. The scan stops as soon as the delta
+    is known to exceed limit.
+
+    The scan advances one byte per missing match, so a target unrelated to base
+    would take about limit steps to reject. A sample is taken first: DELTA_SAMPLES
+    windows of DELTA_BLOCK positions, evenly spaced, each of which contains a block
+    boundary of base if its region is shared with base. If too few windows match
+    for the delta to fit in limit, None is returned without a full scan.
+    """
+    index = {}
+    for offset in range(len(base) - DELTA_BLOCK, -1, -DELTA_BLOCK):
+        index[base[offset:offset + DELTA_BLOCK]] = offset
+    if not _delta_sample_matches(index, target, limit):
+        return None
+    out = bytearray()
+    start = pos = 0
+    end = len(target) - DELTA_BLOCK
+    while pos <= end:
+        offset = index.get(target[pos:pos + DELTA_BLOCK])
+        if offset is None:
+            pos += 1
+            if len(out) + pos - start > limit:
+                return None
+            continue
+        while pos > start and offset > 0 and target[pos - 1] == base[offset - 1]:
+            pos -= 1
+            offset -= 1
+        length = _match_length(base, offset, target, pos)
+        if pos > start:
+            out += _varint((pos - start) << 1) + target[start:pos]
+        out += _varint(length << 1 | 1) + _varint(offset)
+        pos = start = pos + length
+        if len(out) > limit:
+            return None
+    if start < len(target):
+        out += _varint((len(target) - start) << 1) + target[start:]
+    return bytes(out) if len(out) <= limit else None
+
+
+def _apply_delta(base, delta):
+    """Returns the content a delta made by _make_delta produces from base."""
+    out = bytearray()
+    pos = 0
+    while pos < len(delta):
+        n, pos = _read_varint(delta, pos)
+        if n & 1:
+            offset, pos = _read_varint(delta, pos)
+            out += base[offset:offset + (n >> 1)]
+        else:
+            out += delta[pos:pos + (n >> 1)]
+            pos += n >> 1
+    return bytes(out)
+
+# ----------------------------
+# External blob storage
+# ----------------------------
+# Blob content can be placed outside the database, in a store directory beside it.
+# blobs.placement records where each blob is:
+#   inline  - in blobs.content
+#   pack    - appended to a pack file; the row keeps (pack_id, pack_offset, stored_size)
+#   object  - in its own content-addressed file, objects/<first 2 hex digits>/<hex digest>
+#   pieces  - split into pieces listed in chunks, each placed on its own
+# Rows written before placement was recorded have NULL; their placement follows from
+# content and pack_id.
+def _copy_range(src_fd, dst_fd, offset, length):
+    """
+    Copies length bytes of src_fd from offset to the current position of dst_fd
+    inside the kernel, with copy_file_range where the filesystems support it and
+    sendfile otherwise.
+    """
+    copy = getattr(os, "copy_file_range", None)
+    while length > 0:
+        if copy is not None:
+            try:
+                n = copy(src_fd, dst_fd, length, offset)
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                    raise
+                copy = None
+                continue
+        else:
+            n = os.sendfile(dst_fd, src_fd, offset, length)
+        if n == 0:
+            raise OSError(errno.EIO, "stored blob is truncated")
+        offset += n
+        length -= n
+
+
+def _placement(content, pack_id, placement):
+    """Returns a blob's placement, inferring it for rows written before it was recorded."""
+    if placement is not None:
+        return placement
+    if content is not None:
+        return "inline"
+    return "pack" if pack_id is not None else "pieces"
+
+
+def _object_path(objects_dir, blob_hash):
+    name = _hex(blob_hash)
+    return os.path.join(objects_dir, name[:2], name)
+
+
+class _ObjectWriter:
+    """
+    Writes stored content for the snapshot writer as one content-addressed file per
+    blob. Each file is written under a unique temporary name, fsynced and renamed, so
+    an object file is always complete. An existing file is replaced: without a row
+    for it (left by an interrupted snapshot or prune), its codec or delta form may
+    not match the new row. sync() makes the new directory entries durable
+    before the rows pointing at them are committed, and rollback() removes the
+    objects written since the last sync().
+    """
+    placement = "object"
+
+    def __init__(self, objects_dir):
+        self.objects_dir = objects_dir
+        self.written = []
+
+    def put(self, blob_hash, data):
+        """Stores data as the object for blob_hash; returns (None, None)."""
+        path = _object_path(self.objects_dir, blob_hash)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        self.written.append(path)
+        return None, None
+
+    def sync(self):
+        for dir_path in {os.path.dirname(path) for path in self.written}:
+            fd = os.open(dir_path, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        self.written = []
+
+    def rollback(self):
+        for path in self.written:
+            os.remove(path)
+        self.written = []
+
+    def close(self):
+        pass
+
+
+def _pack_path(packs_dir, pack_id):
+    return os.path.join(packs_dir, f"pack-{pack_id:06d}.pack")
+
+
+def _pack_ids(packs_dir):
+    """Returns the ids of the pack files in packs_dir, in ascending order."""
+    try:
+        names = os.listdir(packs_dir)
+    except FileNotFoundError:
+        return []
+    return sorted(int(name[5:-5]) for name in names if re.fullmatch(r"pack-\d+\.pack", name))
+
+
+def _lock_file(path, shared=False):
+    """
+    Opens path and takes an exclusive (or shared) flock on it, waiting until it is
+    granted. Closing the returned file releases the lock. Where fcntl is not
+    available no lock is taken.
+    """
+    f = open(path, "ab")
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+    return f
+
+
+class _PackWriter:
+    """
+    Appends stored blob content to pack files for the snapshot writer. Appending
+    continues in the newest pack until it holds pack_size bytes (a larger blob still
+    goes into a single pack), then a new pack is started. sync() makes everything
+    appended durable before the index rows pointing at it are committed; rollback()
+    removes whatever was appended since the last sync().
+
+    Only one snapshot may append to a repository's packs at a time: the writer holds
+    an exclusive lock on packs_dir/lock from creation until close() or rollback(),
+    and a second writer waits for it. Where fcntl is not available there is no
+    lock, and concurrent snapshots must not use pack storage.
+    """
+    placement = "pack"
+
+    def __init__(self, packs_dir, pack_size=PACK_SIZE):
+        self.packs_dir = packs_dir
+        self.pack_size = pack_size
+        os.makedirs(packs_dir, exist_ok=True)
+        self.lock = _lock_file(os.path.join(packs_dir, "lock"))
+        self.f = None
+        self.pack_id = None
+        self.offset = 0
+        # (pack_id, size) as of the last sync, and the packs started since.
+        self.mark = None
+        self.created = []
+
+    def put(self, blob_hash, data):
+        """Appends data and returns its (pack_id, offset)."""
+        if self.f is None:
+            ids = _pack_ids(self.packs_dir)
+            if ids and os.path.getsize(_pack_path(self.packs_dir, ids[-1])) < self.pack_size:
+                self._open(ids[-1])
+            else:
+                self._open(ids[-1] + 1 if ids else 1)
+        if self.offset and self.offset + len(data) > self.pack_size:
+            self.f.close()
+            self._open(self.pack_id + 1)
+        offset = self.offset
+        self.f.write(data)
+        self.offset += len(data)
+        return self.pack_id, offset
+
+    def _open(self, pack_id):
+        path = _pack_path(self.packs_dir, pack_id)
+        if not os.path.exists(path):
+            self.created.append(pack_id)
+        self.f = open(path, "ab")
+        self.pack_id = pack_id
+        self.offset = self.f.seek(0, os.SEEK_END)
+        if self.mark is None:
+            self.mark = (pack_id, self.offset)
+
+    def sync(self):
+        if self.f is None:
+            return
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.mark = (self.pack_id, self.offset)
+        self.created = []
+
+    def rollback(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+            for pack_id in self.created:
+                os.remove(_pack_path(self.packs_dir, pack_id))
+            pack_id, size = self.mark
+            if pack_id not in self.created:
+                os.truncate(_pack_path(self.packs_dir, pack_id), size)
+            self.mark = None
+            self.created = []
+        self.close()
+
+    def close(self):
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+        # Closing the lock file releases the lock.
+        self.lock.close()
+
+
+class _PackReader:
+    """
+    Serves stored blob content from pack files. read() goes through read-only
+    memory maps, so a read is a slice of mapped memory: no read() call and no copy.
+    copy() moves raw content straight to another file inside the kernel. Open packs
+    are cached, at most MAX_OPEN_PACKS at a time, and remapped if a pack has grown
+    since it was mapped.
+    """
+
+    def __init__(self, packs_dir):
+        self.packs_dir = packs_dir
+        # pack_id -> (file, mmap or None), in least-recently-used order.
+        self.packs = {}
+
+    def _open(self, pack_id, size):
+        f, mm = self.packs.pop(pack_id, (None, None))
+        if f is None:
+            if len(self.packs) >= MAX_OPEN_PACKS:
+                self._close(*self.packs.pop(next(iter(self.packs))))
+            f = open(_pack_path(self.packs_dir, pack_id), "rb")
+        if mm is not None and size > len(mm):
+            mm.close()
+            mm = None
+        # Re-inserting keeps the dict in least-recently-used order.
+        self.packs[pack_id] = (f, mm)
+        return f, mm
+
+    def read(self, pack_id, offset, length):
+        """Returns a memoryview of the stored bytes; release it before close()."""
+        f, mm = self._open(pack_id, offset + length)
+        if mm is None:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.packs[pack_id] = (f, mm)
+        return memoryview(mm)[offset:offset + length]
+
+    def copy(self, pack_id, offset, length, dst_fd):
+        f, _ = self._open(pack_id, 0)
+        _copy_range(f.fileno(), dst_fd, offset, length)
+
+    @staticmethod
+    def _close(f, mm):
+        if mm is not None:
+            mm.close()
+        f.close()
+
+    def close(self):
+        for f, mm in self.packs.values():
+            self._close(f, mm)
+        self.packs.clear()
+
+# ----------------------------
+# Include/exclude rules
+# ----------------------------
+def _glob_to_regex(pattern):
+    """
+    Translates one include/exclude glob into a regular expression matched against a
+    '/'-separated relative path, with a trailing '/' for directories.
+
+    '*' and '?' do not match '/', '**' matches any number of path components and
+    [...] is a character class. A pattern ending in '/' only matches directories. A
+    pattern containing any other '/' is anchored at the snapshot root; otherwise it
+    matches a name at any depth.
+    """
+    dir_only = pattern.endswith("/")
+    pattern = pattern.rstrip("/")
+    anchored = "/" in pattern
+    pattern = pattern.lstrip("/")
+    out = []
+    i, n = 0, len(pattern)
+    while i < n:
+        c = pattern[i]
+        if pattern.startswith("**/", i):
+            out.append("(?:.*/)?")
+            i += 3
+            continue
+        if pattern.startswith("**", i):
+            out.append(".*")
+            i += 2
+            continue
+        if c == "*":
+            out.append("[^/]*")
+        elif c == "?":
+            out.append("[^/]")
+        elif c == "[" and pattern.find("]", i + 2) != -1:
+            end = pattern.find("]", i + 2)
+            body = pattern[i + 1:end]
+            if body.startswith("!"):
+                body = "^" + body[1:]
+            out.append("[" + body.replace("\\", "\\\\") + "]")
+            i = end
+        else:
+            out.append(re.escape(c))
+        i += 1
+    prefix = "" if anchored else "(?:.*/)?"
+    return prefix + "".join(out) + ("/" if dir_only else "/?")
+
+
+class PathFilter:
+    """
+    Ordered include/exclude glob rules compiled into a single regular expression.
+
+    Rules are checked in order and the first one that matches decides; entries that
+    match no rule are included. Each rule becomes one named alternative of the
+    expression, and the regex engine tries alternatives left to right, so a single
+    match per directory entry yields the deciding rule. An excluded directory is
+    never descended into, so nothing below it can be included again.
+    """
+
+    def __init__(self, rules):
+        """rules is a sequence of ("include" | "exclude", glob) pairs."""
+        alternatives = [
+            f"(?P<{action[0]}{i}>{_glob_to_regex(pattern)})"
+            for i, (action, pattern) in enumerate(rules)
+        ]
+        self.regex = re.compile("|".join(alternatives), re.DOTALL) if alternatives else None
+
+    def included(self, rel_path, is_dir):
+        """Returns True if the entry at rel_path should be part of the snapshot."""
+        if self.regex is None:
+            return True
+        if os.sep != "/":
+            rel_path = rel_path.replace(os.sep, "/")
+        m = self.regex.fullmatch(rel_path + "/" if is_dir else rel_path)
+        return m is None or m.lastgroup[0] == "i"
+
+
+class _RuleAction(argparse.Action):
+    """Collects --include/--exclude/--exclude-from values into one list, in command-line order."""
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        rules = getattr(namespace, self.dest) or []
+        if option_string == "--exclude-from":
+            try:
+                with open(values) as f:
+                    lines = [line.strip() for line in f]
+            except OSError as e:
+                parser.error(f"cannot read {values}: {e}")
+            rules.extend(("exclude", line) for line in lines if line and not line.startswith("#"))
+        else:
+            rules.append((option_string.lstrip("-"), values))
+        setattr(namespace, self.dest, rules)
+
+# ----------------------------
+# Known-hash index
+# ----------------------------
+class _KnownHashes:
+    """
+    In-memory membership index over the blob hashes stored in the database, built
+    when a snapshot starts so that most dedup checks never query SQLite.
+
+    Up to KNOWN_SET_LIMIT hashes are kept as an exact set of 32-byte digests. Larger
+    repositories use a Bloom filter instead: a negative answer is final, a positive
+    one is confirmed with a primary-key lookup, and the share of positives that the
+    database refutes is reported as the false-positive rate.
+    """
+
+    def __init__(self, conn, count):
+        self.conn = conn
+        self.lookups = 0
+        self.fallbacks = 0
+        self.false_positives = 0
+        self.negatives = 0
+        if count <= KNOWN_SET_LIMIT:
+            self.exact = set()
+            self.bits = None
+        else:
+            self.exact = None
+            # About 10 bits per hash and 7 probes give a ~1% false-positive rate;
+            # leave room for the hashes added during the snapshot.
+            self.nbits = max(8 * 1024 * 1024, (count + count // 2) * 10)
+            self.bits = bytearray((self.nbits + 7) // 8)
+
+    @classmethod
+    def load(cls, conn):
+        """
+        Builds the index from every binary hash in the blobs table. Blobs still keyed
+        by v1 hex TEXT are left out, so content found only under a hex key is stored
+        again under its binary key; migrate later merges the two copies.
+        """
+        count = conn.execute("SELECT COUNT(*) FROM blobs WHERE typeof(hash) = 'blob'").fetchone()[0]
+        index = cls(conn, count)
+        for (blob_hash,) in conn.execute("SELECT hash FROM blobs WHERE typeof(hash) = 'blob'"):
+            index.add(blob_hash)
+        return index
+
+    def _positions(self, digest):
+        # The digest is already uniformly distributed; derive the probes from it by
+        # double hashing.
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:16], "little") | 1
+        return [(h1 + i * h2) % self.nbits for i in range(7)]
+
+    def add(self, digest):
+        if self.exact is not None:
+            self.exact.add(digest)
+            return
+        for pos in self._positions(digest):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def definitely_contains(self, digest):
+        """
+        Returns True only if the hash is certainly stored. Unlike `in`, this never
+        queries the database, so reader threads may call it while the writer adds.
+        """
+        return self.exact is not None and digest in self.exact
+
+    def __contains__(self, digest):
+        self.lookups += 1
+        if self.exact is not None:
+            return digest in self.exact
+        if not all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(digest)):
+            self.negatives += 1
+            return False
+        self.fallbacks += 1
+        if self.conn.execute("SELECT 1 FROM blobs WHERE hash = ?", (digest,)).fetchone():
+            return True
+        self.false_positives += 1
+        return False
+
+    def describe(self):
+        """One-line summary for the snapshot statistics."""
+        if self.exact is not None:
+            return f"exact set of {len(self.exact)} hashes, {self.lookups} lookups"
+        absent = self.negatives + self.false_positives
+        rate = self.false_positives / absent if absent else 0.0
+        return (f"Bloom filter of {self.nbits // 8} bytes, {self.lookups} lookups, "
+                f"{self.fallbacks} database fallbacks, false-positive rate {rate:.2%}")
+
+# ----------------------------
+# Hardlink tracking
+# ----------------------------
+class _HardlinkTracker:
+    """
+    Shared by the snapshot reader threads so that a file with several hard links is
+    read and hashed once. Inodes are keyed by their full stat metadata, so a file
+    modified between visits to two of its links is treated as two files.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._inodes = {}
+
+    def claim(self, key):
+        """
+        Returns (True, None) to the first caller for key, which must read the file and
+        then call resolve(). Later callers block until then and get (False, blob_hash),
+        where blob_hash is None if the first link could not be read.
+        """
+        with self._lock:
+            entry = self._inodes.get(key)
+            if entry is None:
+                self._inodes[key] = [threading.Event(), None]
+                return True, None
+        entry[0].wait()
+        return False, entry[1]
+
+    def resolve(self, key, blob_hash):
+        with self._lock:
+            entry = self._inodes[key]
+        entry[1] = blob_hash
+        entry[0].set()
+
+# ----------------------------
+# Snapshot writer stage
+# ----------------------------
+class _PathIndex:
+    """
+    Interns file paths for migrate: each directory path is stored once in dirs and
+    each (dir_id, name) pair once in paths, so an entries row records a small
+    integer instead of its full path. Directory ids are cached in memory;
+    a tree has far fewer directories than files.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.dir_ids = {}
+
+    def intern(self, rel_path):
+        """Returns the paths id for rel_path, inserting the rows it needs."""
+        dir_path, name = os.path.split(rel_path)
+        cur = self.conn.cursor()
+        dir_id = self.dir_ids.get(dir_path)
+        if dir_id is None:
+            cur.execute("INSERT OR IGNORE INTO dirs (path) VALUES (?)", (dir_path,))
+            cur.execute("SELECT id FROM dirs WHERE path = ?", (dir_path,))
+            dir_id = self.dir_ids[dir_path] = cur.fetchone()[0]
+        cur.execute("INSERT OR IGNORE INTO paths (dir_id, name) VALUES (?, ?)", (dir_id, name))
+        cur.execute("SELECT id FROM paths WHERE dir_id = ? AND name = ?", (dir_id, name))
+        return cur.fetchone()[0]
+
+
+def _tree_hash(entries):
+    """
+    Returns the content address of a directory tree: the SHA-256 of its entries
+    (name, kind, hash, dev, ino, size, mtime_ns, ctime_ns), sorted by name. The stat
+    metadata is part of the tree, so a directory hashes the same in two snapshots
+    exactly when nothing in it was changed, added or removed.
+    """
+    h = hashlib.sha256()
+    for name, kind, obj_hash, *meta in entries:
+        h.update(f"{kind} {name}\0{' '.join(map(str, meta))}\0".encode("utf-8", "surrogateescape"))
+        h.update(obj_hash)
+    return h.digest()
+
+
+class _TreeBuilder:
+    """
+    Assembles the directory trees of a snapshot from pipeline messages, which
+    arrive in any order. The walker reports how many results each directory listing
+    queued (files and subdirectories); once a directory has received that many, its
+    tree is hashed and passed to on_tree(tree_hash, entries), its entries are
+    dropped, and the tree becomes an entry of its parent. Only directories whose
+    subtree is still in progress are held in memory.
+    """
+
+    def __init__(self, on_tree):
+        self.on_tree = on_tree
+        # rel_dir -> [entries, expected results or None until listed, results received]
+        self.pending = {}
+        self.root = None
+
+    def listed(self, rel_dir, count):
+        state = self.pending.setdefault(rel_dir, [[], None, 0])
+        state[1] = count
+        self._complete(rel_dir, state)
+
+    def add(self, rel_path, entry):
+        """Adds (kind, hash, dev, ino, size, mtime_ns, ctime_ns), or None for a file that could not be read."""
+        rel_dir, name = os.path.split(rel_path)
+        state = self.pending.setdefault(rel_dir, [[], None, 0])
+        state[2] += 1
+        if entry is not None:
+            state[0].append((name,) + entry)
+        self._complete(rel_dir, state)
+
+    def _complete(self, rel_dir, state):
+        entries, expected, received = state
+        if received != expected:
+            return
+        del self.pending[rel_dir]
+        entries.sort()
+        tree_hash = _tree_hash(entries)
+        self.on_tree(tree_hash, entries)
+        if rel_dir:
+            self.add(rel_dir, ("d", tree_hash, None, None, None, None, None))
+        else:
+            self.root = tree_hash
+
+
+class _TreeIndex:
+    """
+    Looks up paths in the tree of a snapshot, caching the tree hash of each directory
+    visited so that each lookup is a single primary-key query.
+    """
+
+    def __init__(self, conn, root_tree):
+        self.cur = conn.cursor()
+        self.dir_trees = {"": root_tree}
+
+    def entry(self, rel_path):
+        """Returns (kind, hash, dev, ino, size, mtime_ns, ctime_ns) for rel_path, or None."""
+        rel_dir, name = os.path.split(rel_path)
+        tree_hash = self._dir_tree(rel_dir)
+        if tree_hash is None:
+            return None
+        self.cur.execute(
+            "SELECT kind, hash, dev, ino, size, mtime_ns, ctime_ns FROM tree_entries "
+            "WHERE tree_hash = ? AND name = ?",
+            (tree_hash, name)
+        )
+        return self.cur.fetchone()
+
+    def _dir_tree(self, rel_dir):
+        if rel_dir not in self.dir_trees:
+            row = self.entry(rel_dir)
+            self.dir_trees[rel_dir] = row[1] if row and row[0] == "d" else None
+        return self.dir_trees[rel_dir]
+
+
+class _SnapshotWriter:
+    """
+    Writer stage of the snapshot pipeline; the only code that writes to the database
+    during a snapshot. Blob, piece-list and tree rows are buffered and written with
+    executemany. Each flush commits, so a snapshot is written as a series of bounded
+    transactions of about commit_rows rows or commit_bytes bytes of content.
+
+    With trees=True the snapshot is stored as tree objects and finish() records its
+    root tree; trees already stored by an earlier snapshot are not written again.
+    Otherwise file rows go to the pre-v3 files table with their full paths.
+
+    If an external store (_PackWriter or _ObjectWriter) is given, new content of at
+    least inline_threshold stored bytes is placed there; smaller content, and all
+    content otherwise, is stored in blobs.content. Each blobs row records its
+    placement. Content sent as a delta is placed the same way.
+
+    In a sharded repository, shards holds a connection to each shard. Blob and
+    piece-list rows are written and committed to all shards in parallel before the
+    rows that reference them are committed to the catalog.
+    """
+
+    def __init__(self, conn, snapshot_id, stats, commit_rows=COMMIT_ROWS, commit_bytes=COMMIT_BYTES,
+                 trees=True, external=None, inline_threshold=INLINE_THRESHOLD, shards=()):
+        self.conn = conn
+        self.shards = shards
+        self.external = external
+        self.inline_threshold = inline_threshold
+        self.snapshot_id = snapshot_id
+        self.stats = stats
+        self.known = _KnownHashes.load(conn)
+        self.trees = _TreeBuilder(self._add_tree) if trees else None
+        self.commit_rows = commit_rows
+        self.commit_bytes = commit_bytes
+        self.blob_rows = []
+        self.chunk_rows = []
+        self.file_rows = []
+        self.tree_rows = []
+        self.tree_entry_rows = []
+        # Hashes of the blobs and trees buffered since the last flush, so that
+        # duplicates within a batch are not handed to SQLite twice.
+        self.pending = set()
+        self.pending_bytes = 0
+
+    def write(self, msg):
+        """Buffers the rows for one message from a walker or reader thread."""
+        kind = msg[0]
+        if kind == "piece":
+            _, chunk_hash, content, codec, size = msg
+            self._add_blob(chunk_hash, content, size, codec)
+        elif kind == "blob":
+            _, blob_hash, content, codec, size, chunk_hashes, delta_base, delta_depth = msg
+            if self._add_blob(blob_hash, content, size, codec, delta_base, delta_depth) and chunk_hashes:
+                # Only new blobs get a piece list: an existing blob may have been split
+                # differently and already has its own.
+                self.chunk_rows.extend(
+                    (blob_hash, seq, chunk_hash) for seq, chunk_hash in enumerate(chunk_hashes)
+                )
+        elif kind == "dir":
+            _, rel_dir, count = msg
+            if self.trees is not None:
+                self.trees.listed(rel_dir, count)
+        else:
+            _, rel_path, blob_hash, meta, source = msg
+            if blob_hash is not None:
+                self.stats["files"] += 1
+                self.stats[source] += 1
+            if self.trees is not None:
+                self.trees.add(rel_path, None if blob_hash is None else ("f", blob_hash) + meta)
+            elif blob_hash is not None:
+                self.file_rows.append((self.snapshot_id, rel_path, blob_hash) + meta)
+        rows = (len(self.blob_rows) + len(self.chunk_rows) + len(self.file_rows)
+                + len(self.tree_entry_rows))
+        if rows >= self.commit_rows or self.pending_bytes >= self.commit_bytes:
+            self.flush()
+
+    def _add_blob(self, blob_hash, content, size, codec, delta_base=None, delta_depth=None):
+        if blob_hash in self.pending or blob_hash in self.known:
+            return False
+        self.pending.add(blob_hash)
+        self.known.add(blob_hash)
+        delta = (delta_base, delta_depth)
+        if content is None:
+            self.blob_rows.append((blob_hash, None, size, codec, None, None, None, "pieces") + delta)
+        elif self.external is not None and len(content) >= self.inline_threshold:
+            pack_id, offset = self.external.put(blob_hash, content)
+            self.blob_rows.append((blob_hash, None, size, codec, pack_id, offset, len(content),
+                                   self.external.placement) + delta)
+        else:
+            self.blob_rows.append((blob_hash, content, size, codec, None, None, None, "inline") + delta)
+        if delta_base is not None:
+            self.stats["deltas"] += 1
+        if content is not None:
+            self.pending_bytes += len(content)
+            self.stats["new_bytes"] += size
+            self.stats["stored_bytes"] += len(content)
+        return True
+
+    def _add_tree(self, tree_hash, entries):
+        self.stats["dirs"] += 1
+        if tree_hash in self.pending:
+            return
+        if self.conn.execute("SELECT 1 FROM trees WHERE hash = ?", (tree_hash,)).fetchone():
+            return
+        self.pending.add(tree_hash)
+        self.stats["new_trees"] += 1
+        self.tree_rows.append((tree_hash,))
+        self.tree_entry_rows.extend((tree_hash,) + entry for entry in entries)
+
+    def flush(self):
+        """Writes all buffered rows and commits."""
+        if self.external is not None:
+            self.external.sync()
+        cur = self.conn.cursor()
+        if self.shards:
+            self._flush_shards()
+        else:
+            _insert_blob_rows(cur, self.chunk_rows, self.blob_rows)
+        # Only databases not yet migrated to schema v3 take file rows.
+        if self.file_rows:
+            cur.executemany(
+                "INSERT INTO files (snapshot_id, path, blob_hash, dev, ino, size, mtime_ns, ctime_ns) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                self.file_rows
+            )
+        if self.tree_rows:
+            _insert_tree_rows(cur, self.tree_rows, self.tree_entry_rows)
+        self.conn.commit()
+        self.blob_rows.clear()
+        self.chunk_rows.clear()
+        self.file_rows.clear()
+        self.tree_rows.clear()
+        self.tree_entry_rows.clear()
+        self.pending.clear()
+        self.pending_bytes = 0
+
+    def _flush_shards(self):
+        """
+        Writes the buffered blob and piece-list rows to their shards, each shard in
+        its own thread and transaction, and returns once all of them committed.
+        """
+        batches = [([], []) for _ in self.shards]
+        for row in self.chunk_rows:
+            batches[_shard_index(row[0], len(self.shards))][0].append(row)
+        for row in self.blob_rows:
+            batches[_shard_index(row[0], len(self.shards))][1].append(row)
+        errors = []
+        threads = [threading.Thread(target=self._write_shard, args=(conn, chunk_rows, blob_rows, errors))
+                   for conn, (chunk_rows, blob_rows) in zip(self.shards, batches) if chunk_rows or blob_rows]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        if errors:
+            raise errors[0]
+
+    @staticmethod
+    def _write_shard(conn, chunk_rows, blob_rows, errors):
+        try:
+            _insert_blob_rows(conn.cursor(), chunk_rows, blob_rows)
+            conn.commit()
+        except Exception as e:
+            conn.rollback()
+            errors.append(e)
+
+    def finish(self):
+        """
+        Writes the remaining rows, records the root tree of the snapshot and marks it
+        complete, in the same transaction as its last rows.
+        """
+        self.conn.execute("UPDATE snapshots SET root_tree = ?, complete = 1 WHERE id = ?",
+                          (self.trees.root if self.trees is not None else None, self.snapshot_id))
+        self.flush()
+        if self.external is not None:
+            self.external.close()
+        for conn in self.shards:
+            conn.close()
+
+    def abort(self):
+        """
+        Discards buffered rows and removes everything already committed for the
+        snapshot. Trees it already wrote may be shared and are left for prune.
+        """
+        self.conn.rollback()
+        if self.external is not None:
+            self.external.rollback()
+        if self.trees is None:
+            self.conn.execute("DELETE FROM files WHERE snapshot_id = ?", (self.snapshot_id,))
+        self.conn.execute("DELETE FROM snapshots WHERE id = ?", (self.snapshot_id,))
+        self.conn.commit()
+        for conn in self.shards:
+            conn.close()
+
+def _shard_index(blob_hash, count):
+    """Returns the shard of a repository with count shards that stores blob_hash."""
+    return blob_hash[0] * count // 256
+
+
+def _shard_schema(index):
+    return f"shard{index:02d}"
+
+
+def _insert_blob_rows(cur, chunk_rows, blob_rows):
+    cur.executemany("INSERT OR IGNORE INTO chunks (blob_hash, seq, chunk_hash) VALUES (?, ?, ?)", chunk_rows)
+    cur.executemany(
+        "INSERT OR IGNORE INTO blobs (hash, content, size, codec, pack_id, pack_offset, stored_size, placement, "
+        "delta_base, delta_depth) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        blob_rows
+    )
+
+def _insert_tree_rows(cur, tree_rows, entry_rows):
+    cur.executemany(
+        "INSERT OR IGNORE INTO tree_entries (tree_hash, name, kind, hash, dev, ino, size, mtime_ns, ctime_ns) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        entry_rows
+    )
+    cur.executemany("INSERT OR IGNORE INTO trees (hash) VALUES (?)", tree_rows)
+
+def _hex(key):
+    """Returns a blob key (binary digest or v1 hex TEXT) as hex for display."""
+    return key.hex() if isinstance(key, bytes) else key
+
+
+# ----------------------------
+# Restore pipeline
+# ----------------------------
+def _streamed_blob_columns(t):
+    """
+    Returns the columns of blobs row t as restore reads them: (hash, content, codec,
+    pack_id, pack_offset, stored_size, placement, delta_base, size). Inline content
+    larger than STREAM_CHUNK is left unread (NULL) for the writer threads to stream,
+    with its length in stored_size, so the placement is spelled out as _placement()
+    would infer it. SQLite gets the length of a BLOB without reading it.
+    """
+    return (f"{t}.hash, CASE WHEN length({t}.content) <= {STREAM_CHUNK} THEN {t}.content END, {t}.codec, "
+            f"{t}.pack_id, {t}.pack_offset, coalesce({t}.stored_size, length({t}.content)), "
+            f"coalesce({t}.placement, CASE WHEN {t}.content IS NOT NULL THEN 'inline' "
+            f"WHEN {t}.pack_id IS NOT NULL THEN 'pack' ELSE 'pieces' END), {t}.delta_base, {t}.size")
+
+
+class _ByteBudget:
+    """
+    Bounds the bytes in flight from a producer thread to its consumers. acquire()
+    blocks while the bytes acquired and not yet released would exceed limit; a
+    single larger amount is let through once nothing else is in flight.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.cond = threading.Condition()
+
+    def acquire(self, n):
+        with self.cond:
+            while self.used and self.used + n > self.limit:
+                self.cond.wait()
+            self.used += n
+
+    def release(self, n):
+        with self.cond:
+            self.used -= n
+            self.cond.notify_all()
+
+
+def _clone_file(src_path, dst_path, mode):
+    """
+    Creates dst_path with the content of the complete file src_path, replacing any
+    file there: with mode "reflink" as a copy-on-write clone that shares its
+    extents, with mode "hardlink" as a hard link to it. Where that is not possible
+    (unsupported filesystem, another device, link count limit), and with mode
+    "copy", the content is copied inside the kernel. Returns the method used.
+    """
+    if os.path.lexists(dst_path):
+        os.unlink(dst_path)
+    if mode == "hardlink":
+        try:
+            os.link(src_path, dst_path)
+            return "hardlink"
+        except OSError:
+            pass
+    with open(src_path, "rb") as src, open(dst_path, "wb") as dst:
+        if mode == "reflink" and fcntl is not None:
+            try:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                return "reflink"
+            except OSError:
+                pass
+        _copy_range(src.fileno(), dst.fileno(), 0, os.fstat(src.fileno()).st_size)
+    return "copy"
+
 
 # ----------------------------
 # BackupTool class definition
 # ----------------------------
 class BackupTool:
-    def __init__(self, db_path):
+    def __init__(self, db_path, shards=0, repo_format=None):
         self.db_path = db_path
+        # Pack and object files kept outside the database.
+        self.packs_dir = os.path.join(db_path + ".store", "packs")
+        self.objects_dir = os.path.join(db_path + ".store", "objects")
+        # Blob store databases of a sharded repository. shards and repo_format only
+        # take effect when the repository is created; an existing one keeps its layout.
+        self.shards_dir = os.path.join(db_path + ".store", "shards")
+        # Held shared by each running snapshot and exclusively by prune.
+        self.lock_path = os.path.join(db_path + ".store", "lock")
         # Connect to the SQLite database (it will be created if it doesn't exist)
         self.conn = sqlite3.connect(self.db_path)
-        self._init_db()
+        # WAL lets the snapshot reader threads query the database while the writer
+        # holds an open transaction.
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self._init_db(shards, repo_format)
+
+    def _init_db(self, shards=0, repo_format=None):
+        """
+        Initializes the database schema. A new database is created at SCHEMA_VERSION;
+        an existing one keeps its version until migrate converts it.
+
+        A new repository created with shards > 0 keeps its blobs and chunks tables in
+        that many shard databases, each holding the blobs whose digest falls in its
+        share of the first-byte range, and the database at db_path becomes a
+        catalog of snapshots, trees and paths. Each shard commits on its own, so
+        snapshot writes to them in parallel, and each is a separate file to copy,
+        check or vacuum.
 
-    def _init_db(self):
-        """Initializes the database schema."""
+        A new repository created with repo_format="objects" stores all content as
+        object files by default (see snapshot), so that the database holds only
+        metadata.
+        """
         cur = self.conn.cursor()
+        cur.execute("SELECT COUNT(*) FROM sqlite_master")
+        fresh = cur.fetchone()[0] == 0
+        cur.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'entries'")
+        # Whether file rows live in entries (schema v3) rather than the older files table.
+        self.normalized = fresh or cur.fetchone() is not None
+        cur.execute("PRAGMA user_version")
+        version = cur.fetchone()[0]
         # Table to store snapshots with a timestamp
         cur.execute('''
             CREATE TABLE IF NOT EXISTS snapshots (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
-                timestamp TEXT
+                timestamp TEXT,
+                root_tree BLOB,
+                complete INTEGER NOT NULL DEFAULT 1
             )
         ''')
-        # Table to store unique file contents (blobs) using SHA-256 hash as key.
-        cur.execute('''
-            CREATE TABLE IF NOT EXISTS blobs (
-                hash TEXT PRIMARY KEY,
+        # Hash of the snapshot's root tree; NULL for snapshots stored as file rows.
+        # complete is 0 while a snapshot is being taken, or after it was interrupted;
+        # such a row is ignored everywhere else.
+        self._add_missing_columns("snapshots", [("root_tree", "BLOB"),
+                                                ("complete", "INTEGER NOT NULL DEFAULT 1")])
+        # Repository layout, fixed when the repository is created.
+        cur.execute("CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value)")
+        if fresh:
+            cur.executemany("INSERT INTO settings (name, value) VALUES (?, ?)",
+                            [setting for setting in (("shards", shards), ("repo_format", repo_format))
+                             if setting[1]])
+        cur.execute("SELECT name, value FROM settings")
+        settings = dict(cur.fetchall())
+        self.shard_count = settings.get("shards", 0)
+        self.repo_format = settings.get("repo_format", "db")
+        if self.shard_count:
+            os.makedirs(self.shards_dir, exist_ok=True)
+            # Databases cannot be attached or switched to WAL inside a transaction.
+            self.conn.commit()
+            self._attach_shards(self.conn, create=True)
+        else:
+            self._create_blob_tables(cur, "main")
+        if fresh:
+            self._create_path_tables(cur)
+        elif not self.normalized:
+            self._create_legacy_files_table(cur)
+        elif version in (3, 4):
+            # v3 to v4 only adds the tree tables, and v4 to v5 only converts entries
+            # rows, so a database without any needs no migrate run.
+            self._create_path_tables(cur)
+            cur.execute("SELECT 1 FROM entries LIMIT 1")
+            version = 4 if cur.fetchone() else 5
+            cur.execute(f"PRAGMA user_version = {version}")
+        if fresh:
+            cur.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+            version = SCHEMA_VERSION
+        self._create_indexes(cur)
+        self.conn.commit()
+        # Databases from before versioning report 0, which is v1.
+        self.schema_version = max(version, 1)
+
+    def _create_blob_tables(self, cur, schema):
+        """
+        Creates the blob store tables and their indexes in the given attached database:
+        the main database, or one shard of a sharded repository.
+        """
+        # Table to store unique file contents (blobs) using the 32-byte SHA-256 digest as key.
+        cur.execute(f'''
+            CREATE TABLE IF NOT EXISTS {schema}.blobs (
+                hash BLOB PRIMARY KEY,
                 content BLOB,
-                size INTEGER
+                size INTEGER,
+                codec TEXT,
+                pack_id INTEGER,
+                pack_offset INTEGER,
+                stored_size INTEGER,
+                placement TEXT,
+                delta_base BLOB,
+                delta_depth INTEGER
+            )
+        ''')
+        # Compression codec of the stored content (NULL for raw), see CODECS, and where the
+        # content is placed (see External blob storage). Content kept in a pack file
+        # records its pack, offset and stored length. A blob stored as a delta records
+        # the blob it applies to and the length of its delta chain (see Delta encoding).
+        self._add_missing_columns("blobs", schema=schema, columns=[
+            ("codec", "TEXT"),
+            ("pack_id", "INTEGER"),
+            ("pack_offset", "INTEGER"),
+            ("stored_size", "INTEGER"),
+            ("placement", "TEXT"),
+            ("delta_base", "BLOB"),
+            ("delta_depth", "INTEGER"),
+        ])
+        # Ordered list of pieces for blobs too large to store in a single row. Each piece
+        # is itself stored in the blobs table; the parent blob row has neither content nor a pack.
+        cur.execute(f'''
+            CREATE TABLE IF NOT EXISTS {schema}.chunks (
+                blob_hash BLOB,
+                seq INTEGER,
+                chunk_hash BLOB,
+                PRIMARY KEY (blob_hash, seq),
+                FOREIGN KEY (blob_hash) REFERENCES blobs(hash),
+                FOREIGN KEY (chunk_hash) REFERENCES blobs(hash)
             )
         ''')
-        # Table to map a snapshot to its files. Files are stored with their relative paths.
+        # Reverse indexes for prune (see _create_indexes).
+        cur.execute(f"CREATE INDEX IF NOT EXISTS {schema}.chunks_chunk_hash ON chunks (chunk_hash)")
+        cur.execute(f"CREATE INDEX IF NOT EXISTS {schema}.blobs_pack_id ON blobs (pack_id) "
+                    "WHERE pack_id IS NOT NULL")
+        cur.execute(f"CREATE INDEX IF NOT EXISTS {schema}.blobs_delta_base ON blobs (delta_base) "
+                    "WHERE delta_base IS NOT NULL")
+
+    def _attach_shards(self, conn, create=False):
+        """
+        Attaches the shard databases of a sharded repository to conn as shard00,
+        shard01, ..., and creates temporary blobs and chunks views over all of them,
+        so that queries read the blob store as if it were one table. SQLite applies
+        the view's conditions to each shard's indexes. Writes go to the shard that
+        _blob_schema names. With create=True, missing shard tables are created first.
+        """
+        cur = conn.cursor()
+        schemas = [_shard_schema(index) for index in range(self.shard_count)]
+        for index, schema in enumerate(schemas):
+            cur.execute(f"ATTACH DATABASE ? AS {schema}", (self._shard_path(index),))
+            cur.execute(f"PRAGMA {schema}.journal_mode=WAL")
+            if create:
+                self._create_blob_tables(cur, schema)
+        for table in ("blobs", "chunks"):
+            cur.execute(f"CREATE TEMP VIEW {table} AS "
+                        + " UNION ALL ".join(f"SELECT * FROM {schema}.{table}" for schema in schemas))
+
+    def _connect(self):
+        """Opens another connection to the repository, with its shards attached."""
+        conn = sqlite3.connect(self.db_path)
+        if self.shard_count:
+            self._attach_shards(conn)
+        return conn
+
+    def _shard_path(self, index):
+        return os.path.join(self.shards_dir, f"shard-{index:02d}.db")
+
+    def _blob_schema(self, blob_hash):
+        """Returns the attached database that stores a blob and its piece list."""
+        if not self.shard_count:
+            return "main"
+        return _shard_schema(_shard_index(blob_hash, self.shard_count))
+
+    def _create_path_tables(self, cur, legacy_table=None):
+        """
+        Creates the file tables of schema v3 and later.
+
+        Snapshots are stored as git-style trees: each directory is a content-addressed
+        tree whose tree_entries rows list its files and subdirectories (name, kind
+        'f' or 'd', blob or tree hash) together with the stat metadata used to detect
+        unchanged files on the next run, and a snapshot records only its root tree.
+        A directory in which nothing changed hashes to a tree that is already stored,
+        so it costs no new rows.
+
+        Snapshots converted by migrate from v2 databases pass through one entries row
+        per file, with paths interned: dirs holds each directory path once and paths
+        each (directory, name) pair once. Migrating to v5 turns them into trees.
+
+        The files view presents both kinds with full paths. Entries rows of a
+        snapshot that already has its root tree are being removed by migrate and
+        are left out. While migrate is moving rows out of legacy_table, the view
+        includes the rows still there.
+        """
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS trees (
+                hash BLOB PRIMARY KEY
+            )
+        ''')
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS tree_entries (
+                tree_hash BLOB,
+                name TEXT,
+                kind TEXT,
+                hash BLOB,
+                dev INTEGER,
+                ino INTEGER,
+                size INTEGER,
+                mtime_ns INTEGER,
+                ctime_ns INTEGER,
+                PRIMARY KEY (tree_hash, name),
+                FOREIGN KEY (tree_hash) REFERENCES trees(hash)
+            ) WITHOUT ROWID
+        ''')
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS dirs (
+                id INTEGER PRIMARY KEY,
+                path TEXT UNIQUE
+            )
+        ''')
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS paths (
+                id INTEGER PRIMARY KEY,
+                dir_id INTEGER,
+                name TEXT,
+                UNIQUE (dir_id, name),
+                FOREIGN KEY (dir_id) REFERENCES dirs(id)
+            )
+        ''')
+        cur.execute('''
+            CREATE TABLE IF NOT EXISTS entries (
+                snapshot_id INTEGER,
+                path_id INTEGER,
+                blob_hash BLOB,
+                dev INTEGER,
+                ino INTEGER,
+                size INTEGER,
+                mtime_ns INTEGER,
+                ctime_ns INTEGER,
+                PRIMARY KEY (snapshot_id, path_id),
+                FOREIGN KEY (snapshot_id) REFERENCES snapshots(id),
+                FOREIGN KEY (path_id) REFERENCES paths(id),
+                FOREIGN KEY (blob_hash) REFERENCES blobs(hash)
+            ) WITHOUT ROWID
+        ''')
+        view = '''
+            CREATE VIEW files AS
+            WITH RECURSIVE walk(snapshot_id, prefix, tree_hash) AS (
+                SELECT id, '', root_tree FROM snapshots WHERE root_tree IS NOT NULL
+                UNION ALL
+                SELECT w.snapshot_id, w.prefix || t.name || '/', t.hash
+                FROM walk w JOIN tree_entries t ON t.tree_hash = w.tree_hash AND t.kind = 'd'
+            )
+            SELECT w.snapshot_id, w.prefix || t.name AS path,
+                   t.hash AS blob_hash, t.dev, t.ino, t.size, t.mtime_ns, t.ctime_ns
+            FROM walk w JOIN tree_entries t ON t.tree_hash = w.tree_hash AND t.kind = 'f'
+            UNION ALL
+            SELECT e.snapshot_id,
+                   CASE d.path WHEN '' THEN p.name ELSE d.path || '/' || p.name END AS path,
+                   e.blob_hash, e.dev, e.ino, e.size, e.mtime_ns, e.ctime_ns
+            FROM entries e JOIN paths p ON p.id = e.path_id JOIN dirs d ON d.id = p.dir_id
+            JOIN snapshots s ON s.id = e.snapshot_id AND s.root_tree IS NULL
+        '''
+        if legacy_table:
+            view += (f"UNION ALL SELECT snapshot_id, path, blob_hash, dev, ino, size, mtime_ns, ctime_ns "
+                     f"FROM {legacy_table}")
+        cur.execute("DROP VIEW IF EXISTS files")
+        cur.execute(view)
+
+    def _create_indexes(self, cur):
+        """
+        Creates the reverse indexes prune uses to find remaining references to what
+        it deletes. Building them on an existing repository is a one-time cost.
+        """
+        cur.execute("CREATE INDEX IF NOT EXISTS snapshots_root_tree ON snapshots (root_tree)")
+        tables = self._entry_tables()
+        if "files" in tables:
+            cur.execute("CREATE INDEX IF NOT EXISTS files_blob_hash ON files (blob_hash)")
+        if "entries" in tables:
+            cur.execute("CREATE INDEX IF NOT EXISTS entries_blob_hash ON entries (blob_hash)")
+            cur.execute("CREATE INDEX IF NOT EXISTS entries_path_id ON entries (path_id)")
+            cur.execute("CREATE INDEX IF NOT EXISTS tree_entries_hash ON tree_entries (hash)")
+
+    def _create_legacy_files_table(self, cur):
+        """
+        Ensures the files table of schema v1 and v2 databases, which stores each file's
+        full path in every snapshot, is complete until migrate converts it.
+        """
         cur.execute('''
             CREATE TABLE IF NOT EXISTS files (
                 snapshot_id INTEGER,
                 path TEXT,
-                blob_hash TEXT,
+                blob_hash BLOB,
+                dev INTEGER,
+                ino INTEGER,
+                size INTEGER,
+                mtime_ns INTEGER,
+                ctime_ns INTEGER,
                 PRIMARY KEY (snapshot_id, path),
                 FOREIGN KEY (snapshot_id) REFERENCES snapshots(id),
                 FOREIGN KEY (blob_hash) REFERENCES blobs(hash)
             )
         ''')
-        self.conn.commit()
+        # Databases created before the stat metadata existed lack these columns.
+        self._add_missing_columns("files", [
+            ("dev", "INTEGER"),
+            ("ino", "INTEGER"),
+            ("size", "INTEGER"),
+            ("mtime_ns", "INTEGER"),
+            ("ctime_ns", "INTEGER"),
+        ])
+
+    def _lock_repository(self, shared):
+        """Takes the repository lock (see _lock_file); closing the result releases it."""
+        os.makedirs(os.path.dirname(self.lock_path), exist_ok=True)
+        return _lock_file(self.lock_path, shared)
+
+    def _add_missing_columns(self, table, columns, schema="main"):
+        """Adds any of the given (name, type) columns that an existing table lacks."""
+        cur = self.conn.cursor()
+        cur.execute(f"PRAGMA {schema}.table_info({table})")
+        existing = {row[1] for row in cur.fetchall()}
+        for name, col_type in columns:
+            if name not in existing:
+                cur.execute(f"ALTER TABLE {schema}.{table} ADD COLUMN {name} {col_type}")
 
-    def snapshot(self, target_directory):
+    def snapshot(self, target_directory, rehash=False, chunker=None, jobs=DEFAULT_JOBS,
+                 commit_rows=COMMIT_ROWS, commit_bytes=COMMIT_BYTES, path_filter=None,
+                 compression=None, compression_level=None, storage=None, pack_size=PACK_SIZE,
+                 inline_threshold=None, delta=False):
         """
         Takes a snapshot of all files in the specified directory.
         Files are read in binary mode; only content and filename (as a relative path)
-        are stored in the database.
+        are stored in the database, along with each file's stat metadata.
+
+        A file whose device, inode, size, mtime and ctime match its entry in the
+        previous snapshot is not read again: the previous blob hash is reused.
+        Pass rehash=True to read and hash every file regardless.
+
+        Files are split into fixed CHUNK_SIZE pieces unless a chunker such as FastCDC
+        is given, in which case piece boundaries follow the content so that only the
+        changed regions of a modified file are stored again.
+
+        Ingest runs as a pipeline connected by bounded queues: `jobs` walker threads
+        list and stat files with os.scandir, descending into independent
+        subdirectories concurrently, `jobs` reader threads read and hash them (hashlib releases the
+        GIL, so hashing runs in parallel), and the calling thread is the single writer
+        that owns the SQLite connection. The writer batches rows and commits every
+        commit_rows rows or commit_bytes bytes of content; if the snapshot fails, the
+        rows already committed for it are removed.
+
+        If a PathFilter is given, entries it excludes are skipped during the walk;
+        excluded directories are not descended into.
+
+        A file with several hard links in the tree is read once; the other links
+        reuse its blob hash.
+
+        The snapshot is stored as directory trees (see _create_path_tables); a
+        directory in which nothing changed reuses the tree of an earlier snapshot, so
+        rows are written only for what changed. Databases not yet migrated to schema
+        v3 get one files row per file instead.
+
+        compression names one of CODECS; new content is compressed with it at
+        compression_level (the codec's default if None), except for data that a quick
+        probe finds incompressible, which is stored raw.
+
+        storage is "db" to store all new content in the database. With "pack" or
+        "object", content of at least inline_threshold stored bytes is placed outside
+        the database, appended to pack files of up to pack_size bytes or written as
+        one file per blob, and only its location is kept in the database; smaller
+        content stays inline. A repository can hold any mix of placements. If
+        storage is None, the repository format decides: "object" with an
+        inline_threshold of 0 for an objects repository, otherwise "db". An
+        inline_threshold of None means INLINE_THRESHOLD.
+
+        With delta=True, a changed file that fits in one piece is stored as a delta
+        against its content in the previous snapshot when the delta is at most
+        DELTA_RATIO of the size of storing it in full. Restoring a file applies its
+        whole delta chain, so chains are cut at MAX_DELTA_DEPTH by storing the next
+        version in full. Delta encoding needs schema v2 or later.
         """
         target_directory = os.path.abspath(target_directory)
+        if storage is None:
+            storage = "object" if self.repo_format == "objects" else "db"
+        if inline_threshold is None:
+            inline_threshold = 0 if self.repo_format == "objects" else INLINE_THRESHOLD
         timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        cur = self.conn.cursor()
-        cur.execute("INSERT INTO snapshots (timestamp) VALUES (?)", (timestamp,))
-        snapshot_id = cur.lastrowid
-
-        for root, dirs, files in os.walk(target_directory):
-            for file in files:
-                file_path = os.path.join(root, file)
-                # Compute the relative path so that the directory structure is preserved on restore.
-                rel_path = os.path.relpath(file_path, target_directory)
-                try:
-                    with open(file_path, "rb") as f:
-                        content = f.read()
-                except Exception as e:
-                    print(f"Error reading {file_path}: {e}")
+        # Prune waits for running snapshots, as they reuse blobs they have not written
+        # tree rows for yet. The locks are taken before the snapshot row opens a write
+        # transaction, so a snapshot waiting for one does not hold up the others.
+        repository_lock = self._lock_repository(shared=True)
+        try:
+            # A snapshot waiting for the pack lock does not hold up the one appending.
+            if storage == "pack":
+                external = _PackWriter(self.packs_dir, pack_size)
+            elif storage == "object":
+                external = _ObjectWriter(self.objects_dir)
+            else:
+                external = None
+            cur = self.conn.cursor()
+            try:
+                cur.execute("SELECT id, root_tree FROM snapshots WHERE complete ORDER BY id DESC LIMIT 1")
+                previous = None if rehash else cur.fetchone()
+                # Batches are committed as they are written, so the row stays incomplete
+                # until finish() marks it in the last one.
+                cur.execute("INSERT INTO snapshots (timestamp, complete) VALUES (?, 0)", (timestamp,))
+            except BaseException:
+                if external is not None:
+                    external.close()
+                raise
+            snapshot_id = cur.lastrowid
+            self.stats = {"files": 0, "unchanged": 0, "read": 0, "hardlink": 0,
+                          "new_bytes": 0, "stored_bytes": 0, "dirs": 0, "new_trees": 0, "deltas": 0}
+            # Shard connections are used by one flush thread at a time.
+            shards = [sqlite3.connect(self._shard_path(index), check_same_thread=False)
+                      for index in range(self.shard_count)]
+            writer = _SnapshotWriter(self.conn, snapshot_id, self.stats, commit_rows, commit_bytes,
+                                     self.normalized, external, inline_threshold, shards)
+
+            paths = queue.Queue(maxsize=jobs * 64)
+            results = queue.Queue(maxsize=jobs * 4)
+            stop = threading.Event()
+            errors = []
+            threads = [threading.Thread(target=self._walk_worker,
+                                        args=(target_directory, paths, results, jobs, path_filter, stop, errors))]
+            hardlinks = _HardlinkTracker()
+            store = functools.partial(self._pack_content, writer.known, compression, compression_level)
+            delta = delta and self.schema_version >= 2
+            threads += [threading.Thread(target=self._read_worker,
+                                         args=(paths, results, previous, chunker, store, delta, hardlinks, stop,
+                                               errors))
+                        for _ in range(jobs)]
+            for t in threads:
+                t.start()
+            finished = 0
+            try:
+                while finished < jobs:
+                    msg = results.get()
+                    if msg is None:
+                        finished += 1
+                    elif not stop.is_set():
+                        writer.write(msg)
+                if not errors:
+                    writer.finish()
+            except BaseException:
+                # Let the other stages wind down before propagating the error.
+                stop.set()
+                while finished < jobs:
+                    if results.get() is None:
+                        finished += 1
+                writer.abort()
+                raise
+            finally:
+                for t in threads:
+                    t.join()
+            if errors:
+                writer.abort()
+                raise errors[0]
+            print(f"Snapshot {snapshot_id} taken at {timestamp}")
+            print(f"  {self.stats['files']} files: {self.stats['unchanged']} unchanged, {self.stats['read']} read, "
+                  f"{self.stats['hardlink']} extra hard links")
+            print(f"  new content: {self.stats['new_bytes']} bytes stored as {self.stats['stored_bytes']} bytes")
+            if delta:
+                print(f"  {self.stats['deltas']} blobs stored as deltas")
+            if self.normalized:
+                print(f"  {self.stats['dirs']} directories: {self.stats['new_trees']} new trees")
+            print(f"  known-hash index: {writer.known.describe()}")
+        finally:
+            repository_lock.close()
+
+    def _walk_worker(self, target_directory, paths, results, jobs, path_filter, stop, errors):
+        """
+        Walker stage: traverses target_directory with `jobs` scandir threads and puts
+        (file_path, rel_path, stat_result) tuples on paths, then one None per reader.
+        For each directory listed, ("dir", rel_dir, count) goes to results.
+        """
+        dirs = queue.Queue()
+        dirs.put((target_directory, ""))
+        walkers = [threading.Thread(target=self._scan_worker, args=(dirs, paths, results, path_filter, stop, errors))
+                   for _ in range(jobs)]
+        for t in walkers:
+            t.start()
+        try:
+            # Every directory is marked done only after its subdirectories were queued,
+            # so the queue drains exactly when the whole tree has been listed.
+            dirs.join()
+        finally:
+            for _ in walkers:
+                dirs.put(None)
+            for t in walkers:
+                t.join()
+            for _ in range(jobs):
+                paths.put(None)
+
+    def _scan_worker(self, dirs, paths, results, path_filter, stop, errors):
+        """
+        Lists one directory at a time from dirs, streaming its files onto paths as
+        they are read and queueing its subdirectories for any walker thread to take.
+        Symlinks to directories are not followed, and entries rejected by path_filter
+        are dropped before they are queued. Once a directory is listed, the number of
+        files and subdirectories queued from it is sent to the writer, which needs it
+        to know when the directory's tree is complete.
+        """
+        while True:
+            item = dirs.get()
+            if item is None:
+                dirs.task_done()
+                return
+            dir_path, rel_dir = item
+            count = 0
+            try:
+                if not stop.is_set():
+                    with os.scandir(dir_path) as entries:
+                        for entry in entries:
+                            # Compute the relative path so that the directory structure is preserved on restore.
+                            rel_path = os.path.join(rel_dir, entry.name) if rel_dir else entry.name
+                            is_dir = entry.is_dir(follow_symlinks=False)
+                            if path_filter is not None and not path_filter.included(rel_path, is_dir):
+                                continue
+                            if is_dir:
+                                dirs.put((entry.path, rel_path))
+                                count += 1
+                            elif entry.is_file():
+                                # DirEntry caches the stat result, so readers never stat again.
+                                try:
+                                    st = entry.stat()
+                                except OSError as e:
+                                    print(f"Error reading {entry.path}: {e}")
+                                    continue
+                                paths.put((entry.path, rel_path, st))
+                                count += 1
+            except OSError as e:
+                print(f"Error reading {dir_path}: {e}")
+            except Exception as e:
+                errors.append(e)
+                stop.set()
+            finally:
+                results.put(("dir", rel_dir, count))
+                dirs.task_done()
+
+    def _read_worker(self, paths, results, previous, chunker, store, delta, hardlinks, stop, errors):
+        """
+        Reader/hasher stage: for each file taken from paths, reuses the blob hash of
+        another link to the same inode or of the previous snapshot's entry, or else
+        reads and hashes the file, putting the resulting messages on results. previous
+        is the (id, root_tree) of the previous snapshot, or None. A ("file", ...)
+        message is sent for every file, with a None hash if it could not be read. Puts
+        None on results when done.
+
+        With delta=True, a file that changed since the previous snapshot may be sent
+        as a delta against its previous version.
+        """
+        # sqlite3 connections cannot be shared between threads, so each reader looks
+        # up the previous snapshot through its own connection.
+        conn = self._connect() if previous is not None else None
+        tree = _TreeIndex(conn, previous[1]) if previous is not None and previous[1] is not None else None
+        packs = _PackReader(self.packs_dir) if delta and conn is not None else None
+        try:
+            while True:
+                item = paths.get()
+                if item is None:
+                    break
+                if stop.is_set():
                     continue
-                # Calculate SHA-256 hash
-                blob_hash = hashlib.sha256(content).hexdigest()
-                # Insert blob if it does not exist
-                cur.execute("SELECT 1 FROM blobs WHERE hash = ?", (blob_hash,))
-                if not cur.fetchone():
-                    cur.execute(
-                        "INSERT INTO blobs (hash, content, size) VALUES (?, ?, ?)",
-                        (blob_hash, content, len(content))
-                    )
-                # Insert file entry for this snapshot
+                file_path, rel_path, st = item
+                meta = (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns)
+                first_link, blob_hash = True, None
+                if st.st_nlink > 1:
+                    first_link, blob_hash = hardlinks.claim(meta)
+                    if not first_link and blob_hash is None:
+                        # The first link failed to read and reported the error.
+                        results.put(("file", rel_path, None, meta, "hardlink"))
+                        continue
+                source = "hardlink"
+                try:
+                    make_delta = None
+                    if blob_hash is None and conn is not None:
+                        entry = self._previous_entry(conn.cursor(), previous[0], tree, rel_path)
+                        if entry is not None and entry[1:] == meta:
+                            blob_hash = entry[0]
+                        elif entry is not None and packs is not None:
+                            make_delta = functools.partial(self._delta_content, conn.cursor(), packs, entry[0], store)
+                        source = "unchanged"
+                    if blob_hash is None:
+                        source = "read"
+                        try:
+                            with open(file_path, "rb") as f:
+                                blob_hash = self._read_file(f, chunker, store, results.put, make_delta)
+                        except Exception as e:
+                            print(f"Error reading {file_path}: {e}")
+                finally:
+                    if st.st_nlink > 1 and first_link:
+                        hardlinks.resolve(meta, blob_hash)
+                results.put(("file", rel_path, blob_hash, meta, source))
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+            while paths.get() is not None:
+                pass
+        finally:
+            if packs is not None:
+                packs.close()
+            if conn is not None:
+                conn.close()
+            results.put(None)
+
+    def _read_file(self, f, chunker, store, emit, delta=None):
+        """
+        Reads an open file piece by piece and returns the SHA-256 digest of the
+        whole file. Pieces are CHUNK_SIZE bytes, or chosen by chunker.split() if a
+        chunker is given; at most two are held in memory.
+
+        The content is passed to emit() as messages for the writer, with store(hash,
+        content) giving the (stored_content, codec) to send. A file that fits in one
+        piece becomes a single ("blob", hash, stored, codec, size, None, delta_base,
+        delta_depth) message. A larger file becomes one ("piece", hash, stored, codec,
+        size) message per piece followed by ("blob", hash, None, None, size,
+        piece_hashes, None, None).
+
+        If delta is given, a new single-piece file is offered to delta(hash, content,
+        stored), which returns (stored, codec, delta_base, delta_depth) to send it as
+        a delta instead, or None.
+        """
+        if chunker is not None:
+            pieces = chunker.split(f)
+        else:
+            pieces = iter(lambda: f.read(CHUNK_SIZE), b"")
+        first = next(pieces, b"")
+        second = next(pieces, b"")
+        if not second:
+            blob_hash = hashlib.sha256(first).digest()
+            stored, codec = store(blob_hash, first)
+            packed = None
+            if stored is not None and delta is not None:
+                packed = delta(blob_hash, first, stored)
+            if packed is None:
+                packed = (stored, codec, None, None)
+            emit(("blob", blob_hash) + packed[:2] + (len(first), None) + packed[2:])
+            return blob_hash
+
+        file_hash = hashlib.sha256()
+        chunk_hashes = []
+        size = 0
+        for piece in itertools.chain((first, second), pieces):
+            file_hash.update(piece)
+            chunk_hash = hashlib.sha256(piece).digest()
+            emit(("piece", chunk_hash) + store(chunk_hash, piece) + (len(piece),))
+            chunk_hashes.append(chunk_hash)
+            size += len(piece)
+        blob_hash = file_hash.digest()
+        emit(("blob", blob_hash, None, None, size, chunk_hashes, None, None))
+        return blob_hash
+
+    @staticmethod
+    def _pack_content(known, compression, compression_level, blob_hash, content):
+        """
+        Returns (stored_content, codec) for content about to be sent to the writer.
+        Content the writer certainly has already is not compressed or sent at all.
+        """
+        if known.definitely_contains(blob_hash):
+            return None, None
+        return _compress(content, compression, compression_level)
+
+    def _previous_entry(self, cur, previous_id, tree, rel_path):
+        """
+        Returns (blob_hash, dev, ino, size, mtime_ns, ctime_ns) recorded for rel_path
+        in the previous snapshot, or None if it had no such file. tree is a
+        _TreeIndex of the previous snapshot if it is stored as trees.
+        """
+        if tree is not None:
+            row = tree.entry(rel_path)
+            row = row[1:] if row and row[0] == "f" else None
+        else:
+            if self.normalized:
+                # Rows migrate has not moved into entries yet are not found, so those
+                # files are simply read again.
+                dir_path, name = os.path.split(rel_path)
                 cur.execute(
-                    "INSERT INTO files (snapshot_id, path, blob_hash) VALUES (?, ?, ?)",
-                    (snapshot_id, rel_path, blob_hash)
+                    "SELECT e.blob_hash, e.dev, e.ino, e.size, e.mtime_ns, e.ctime_ns "
+                    "FROM dirs d JOIN paths p ON p.dir_id = d.id AND p.name = ? "
+                    "JOIN entries e ON e.snapshot_id = ? AND e.path_id = p.id "
+                    "WHERE d.path = ?",
+                    (name, previous_id, dir_path)
                 )
-        self.conn.commit()
-        print(f"Snapshot {snapshot_id} taken at {timestamp}")
+            else:
+                cur.execute(
+                    "SELECT blob_hash, dev, ino, size, mtime_ns, ctime_ns FROM files "
+                    "WHERE snapshot_id = ? AND path = ?",
+                    (previous_id, rel_path)
+                )
+            row = cur.fetchone()
+        return tuple(row) if row else None
+
+    def _delta_content(self, cur, packs, base_hash, store, blob_hash, content, stored):
+        """
+        Returns (stored, codec, base_hash, delta_depth) to store content as a delta
+        against the blob base_hash, or None if the base is missing, stored in pieces
+        or at the end of a MAX_DELTA_DEPTH chain, or if the delta would be more than
+        DELTA_RATIO of stored, the content stored in full.
+        """
+        base = self._blob_content(cur, packs, base_hash)
+        if base is None or base[1] >= MAX_DELTA_DEPTH:
+            return None
+        delta = _make_delta(base[0], content, int(len(content) * DELTA_RATIO))
+        if delta is None:
+            return None
+        delta_stored, codec = store(blob_hash, delta)
+        # The writer may have been sent the same content since the full version was
+        # stored (stored is None then); the full message lets it deduplicate that.
+        if delta_stored is None or len(delta_stored) > len(stored) * DELTA_RATIO:
+            return None
+        return delta_stored, codec, base_hash, base[1] + 1
 
     def list_snapshots(self):
         """Lists all snapshots with their snapshot number and timestamp."""
         cur = self.conn.cursor()
-        cur.execute("SELECT id, timestamp FROM snapshots ORDER BY id")
-        rows = cur.fetchall()
-        if rows:
-            print(f"{'SNAPSHOT':<9} TIMESTAMP")
-            for row in rows:
-                print(f"{row[0]:<9} {row[1]}")
-        else:
-            print("No snapshots found.")
+        cur.execute("SELECT id, timestamp FROM snapshots WHERE complete ORDER BY id")
+        rows = cur.fetchall()
+        if rows:
+            print(f"{'SNAPSHOT':<9} TIMESTAMP")
+            for row in rows:
+                print(f"{row[0]:<9} {row[1]}")
+        else:
+            print("No snapshots found.")
+
+    def restore(self, snapshot_id, output_directory, hardlinks=False, jobs=DEFAULT_JOBS,
+                buffer_bytes=RESTORE_BUFFER_BYTES, incremental=False, delete=False, dedup=None):
+        """
+        Restores the state of a directory from the snapshot identified by snapshot_id.
+        The directory structure and file contents are re-created exactly as stored,
+        and each file gets the modification time it had when the snapshot was taken.
+
+        Restore runs as a pipeline: the calling thread owns the SQLite connection and
+        reads each file's stored content, and `jobs` writer threads create the
+        directories and write the files. Content in pack and object files is read by
+        the writers themselves. At most buffer_bytes of content read from the
+        database wait for a writer at any time. A file stored in pieces is created
+        first and each piece is then written at its offset, so the pieces of one
+        file can be written by several threads.
+
+        With incremental=True, a file already in output_directory is kept if its size
+        and modification time match the snapshot, or if its size matches and its
+        content hashes to the snapshot's blob; anything else at the path, or a file
+        or symlink where one of its directories should be, is removed and the file
+        is written. With delete=True, files and directories in output_directory that
+        are not in the snapshot are removed first.
+
+        With hardlinks=True, paths that were hard links to the same inode when the
+        snapshot was taken are restored as hard links again, once all files are
+        written; if linking fails, the content is written as a separate file.
+
+        With dedup set to "reflink", "hardlink" or "copy", the content of each blob
+        is written only to the first path that has it. Once all files are written,
+        the other paths with that blob are created from that file by _clone_file():
+        as copy-on-write clones, as hard links, or as kernel-side copies. Reflinks and
+        hard links fall back to copies where the filesystem refuses them.
+        """
+        cur = self.conn.cursor()
+        # Check if snapshot exists
+        cur.execute("SELECT root_tree FROM snapshots WHERE id = ? AND complete", (snapshot_id,))
+        row = cur.fetchone()
+        if not row:
+            print(f"Snapshot {snapshot_id} not found.")
+            return
+
+        if not os.path.exists(output_directory):
+            os.makedirs(output_directory)
+        if delete:
+            if row[0] is None:
+                print(f"Note: snapshot {snapshot_id} is not stored as a tree; run 'migrate' "
+                      "to use --delete. No files were deleted.")
+            else:
+                removed = self._delete_extra(output_directory, _TreeIndex(self.conn, row[0]))
+                print(f"Deleted {removed} paths not in snapshot {snapshot_id}")
+
+        rows = self._snapshot_files(self.conn.cursor(), snapshot_id, row[0])
+        linked = {}
+        links = []
+        pieced = []
+        kept = 0
+        written = {}
+        clones = []
+        checked_dirs = set()
+        work = queue.Queue(maxsize=jobs * 4)
+        budget = _ByteBudget(buffer_bytes)
+        stop = threading.Event()
+        errors = []
+        threads = [threading.Thread(target=self._restore_worker, args=(work, budget, stop, errors))
+                   for _ in range(jobs)]
+        for t in threads:
+            t.start()
+        packs = _PackReader(self.packs_dir)
+        try:
+            for path, dev, ino, blob_hash, *stored, size, mtime_ns in rows:
+                if stop.is_set():
+                    break
+                out_path = os.path.join(output_directory, path)
+                if incremental:
+                    self._clear_ancestors(output_directory, path, checked_dirs)
+                if hardlinks and ino is not None:
+                    first_path = linked.setdefault((dev, ino, blob_hash), out_path)
+                    if first_path != out_path:
+                        links.append((first_path, out_path, path, blob_hash, mtime_ns))
+                        continue
+                if incremental and self._up_to_date(out_path, stored[8] if size is None else size,
+                                                    mtime_ns, blob_hash):
+                    kept += 1
+                    if dedup:
+                        written.setdefault(blob_hash, out_path)
+                    continue
+                if dedup and blob_hash in written:
+                    clones.append((written[blob_hash], out_path, mtime_ns))
+                    continue
+                missing = self._queue_blob(cur, packs, work, budget, out_path, blob_hash,
+                                           stored if stored[0] is not None else None, mtime_ns, pieced)
+                if missing is not None:
+                    print(f"Error: missing blob {_hex(missing)} for file {path}")
+                elif dedup:
+                    written[blob_hash] = out_path
+        finally:
+            for _ in threads:
+                work.put(None)
+            for t in threads:
+                t.join()
+            if errors:
+                packs.close()
+                raise errors[0]
+        try:
+            # Files written piece by piece by several threads get their times once complete.
+            for out_path, mtime_ns in pieced:
+                os.utime(out_path, ns=(mtime_ns, mtime_ns))
+            # Paths sharing a blob are created from the first one, which is now complete.
+            methods = {"reflink": 0, "hardlink": 0, "copy": 0}
+            for first_path, out_path, mtime_ns in clones:
+                os.makedirs(os.path.dirname(out_path), exist_ok=True)
+                method = _clone_file(first_path, out_path, dedup)
+                methods[method] += 1
+                if method != "hardlink" and mtime_ns is not None:
+                    os.utime(out_path, ns=(mtime_ns, mtime_ns))
+            # Links are made only now that the files they point to are complete.
+            for first_path, out_path, path, blob_hash, mtime_ns in links:
+                os.makedirs(os.path.dirname(out_path), exist_ok=True)
+                if self._link(first_path, out_path):
+                    continue
+                with open(out_path, "wb") as f:
+                    missing = self._write_blob(cur, packs, blob_hash, f)
+                if missing is not None:
+                    print(f"Error: missing blob {_hex(missing)} for file {path}")
+                elif mtime_ns is not None:
+                    os.utime(out_path, ns=(mtime_ns, mtime_ns))
+        finally:
+            packs.close()
+        if incremental:
+            print(f"{kept} unchanged files kept")
+        if dedup:
+            print(f"{len(clones)} files with duplicate content: {methods['reflink']} reflinked, "
+                  f"{methods['hardlink']} hard-linked, {methods['copy']} copied")
+        print(f"Snapshot {snapshot_id} restored to {output_directory}")
+
+    def _up_to_date(self, out_path, size, mtime_ns, blob_hash):
+        """
+        Returns True if out_path is a regular file with the given size and either the
+        given modification time or content hashing to blob_hash; a file found
+        unchanged by its hash gets the modification time, so the next check is quick.
+        Otherwise removes whatever is at out_path and returns False.
+        """
+        try:
+            st = os.lstat(out_path)
+        except FileNotFoundError:
+            return False
+        if stat.S_ISREG(st.st_mode) and (size is None or st.st_size == size):
+            if mtime_ns is not None and st.st_mtime_ns == mtime_ns:
+                return True
+            file_hash = hashlib.sha256()
+            with open(out_path, "rb") as f:
+                for piece in iter(lambda: f.read(CHUNK_SIZE), b""):
+                    file_hash.update(piece)
+            if file_hash.digest() in self._key_forms(blob_hash):
+                if mtime_ns is not None:
+                    os.utime(out_path, ns=(mtime_ns, mtime_ns))
+                return True
+        # The file is replaced rather than overwritten, so other hard links to it
+        # and the targets of symlinks are left alone.
+        if stat.S_ISDIR(st.st_mode):
+            shutil.rmtree(out_path)
+        else:
+            os.unlink(out_path)
+        return False
+
+    @staticmethod
+    def _clear_ancestors(output_directory, rel_path, checked):
+        """
+        Makes sure every directory of rel_path below output_directory is a real
+        directory, so that writing rel_path neither fails nor follows a symlink out
+        of output_directory: the first file or symlink found in the place of one is
+        removed (nothing can exist below it) and the directories are created when the
+        file is written. Directories found are added to checked and not looked at
+        again.
+        """
+        parts = rel_path.split("/")[:-1]
+        for i in range(1, len(parts) + 1):
+            rel_dir = "/".join(parts[:i])
+            if rel_dir in checked:
+                continue
+            dir_path = os.path.join(output_directory, rel_dir)
+            try:
+                st = os.lstat(dir_path)
+            except FileNotFoundError:
+                return
+            if not stat.S_ISDIR(st.st_mode):
+                os.unlink(dir_path)
+                return
+            checked.add(rel_dir)
+
+    @staticmethod
+    def _delete_extra(output_directory, index):
+        """
+        Removes the files and directories under output_directory that are not in the
+        snapshot tree of the _TreeIndex index, or are there as the other kind, and
+        returns how many were removed. Directories not in the snapshot are removed
+        whole without being looked into.
+        """
+        removed = 0
+        pending = [""]
+        while pending:
+            rel_dir = pending.pop()
+            with os.scandir(os.path.join(output_directory, rel_dir)) as it:
+                found = list(it)
+            for entry in found:
+                rel_path = os.path.join(rel_dir, entry.name)
+                is_dir = entry.is_dir(follow_symlinks=False)
+                row = index.entry(rel_path)
+                if row is not None and (row[0] == "d") == is_dir:
+                    if is_dir:
+                        pending.append(rel_path)
+                    continue
+                if is_dir:
+                    shutil.rmtree(entry.path)
+                else:
+                    os.unlink(entry.path)
+                removed += 1
+        return removed
+
+    def _queue_blob(self, cur, packs, work, budget, out_path, blob_hash, row=None, mtime_ns=None, pieced=None):
+        """
+        Queues (out_path, offset, stored_row, mtime_ns) items for restore's writer
+        threads from the blobs row of a blob, looking it up if row is None: one item
+        with offset None that writes the whole file and sets its modification time,
+        or, for a blob stored in pieces, one per piece at its offset in the file,
+        which is created here and appended to pieced with mtime_ns. Returns None, or
+        the hash of the blob or piece that is missing from the database.
+        """
+        query = ("SELECT hash, content, codec, pack_id, pack_offset, stored_size, placement, delta_base, size "
+                 "FROM blobs WHERE hash IN (?, ?)")
+        if row is None:
+            cur.execute(query, self._key_forms(blob_hash))
+            row = cur.fetchone()
+        if not row:
+            return blob_hash
+        if row[7] is not None:
+            blob = self._blob_content(cur, packs, row[0])
+            if blob is None:
+                return row[7]
+            self._queue_item(work, budget,
+                             (out_path, None, (row[0], blob[0], None, None, None, None, "inline"), mtime_ns))
+            return None
+        if _placement(row[1], row[3], row[6]) != "pieces":
+            self._queue_item(work, budget, (out_path, None, row[:7], mtime_ns))
+            return None
+        os.makedirs(os.path.dirname(out_path), exist_ok=True)
+        open(out_path, "wb").close()
+        if mtime_ns is not None and pieced is not None:
+            pieced.append((out_path, mtime_ns))
+        offset = 0
+        for chunk_hash, *piece in self._piece_rows(row[0]):
+            if piece[0] is None:
+                cur.execute(query, self._key_forms(chunk_hash))
+                piece = cur.fetchone()
+                if not piece:
+                    return chunk_hash
+            self._queue_item(work, budget, (out_path, offset, piece[:7], None))
+            offset += piece[8]
+        return None
+
+    def _piece_rows(self, stored_hash):
+        """
+        Yields (chunk_hash, *columns) for each piece of a blob stored in pieces, in
+        order, with the piece's blobs row as _streamed_blob_columns() reads it, or
+        Nones if it is missing.
+        """
+        pieces = self.conn.cursor()
+        if not self.shard_count:
+            pieces.execute(
+                f"SELECT c.chunk_hash, {_streamed_blob_columns('p')} "
+                "FROM chunks c LEFT JOIN blobs p ON p.hash = c.chunk_hash WHERE c.blob_hash = ? ORDER BY c.seq",
+                (stored_hash,)
+            )
+            yield from pieces
+            return
+        # Joining through the blobs view would read every shard for each file, so the
+        # piece list is read from the blob's shard and each piece from its own.
+        lookup = self.conn.cursor()
+        pieces.execute(f"SELECT chunk_hash FROM {self._blob_schema(stored_hash)}.chunks "
+                       "WHERE blob_hash = ? ORDER BY seq", (stored_hash,))
+        for (chunk_hash,) in pieces:
+            lookup.execute(f"SELECT {_streamed_blob_columns('p')} FROM {self._blob_schema(chunk_hash)}.blobs p "
+                           "WHERE p.hash = ?", (chunk_hash,))
+            yield (chunk_hash, *(lookup.fetchone() or (None,) * 9))
+
+    @staticmethod
+    def _queue_item(work, budget, item):
+        content = item[2][1]
+        budget.acquire(0 if content is None else len(content))
+        work.put(item)
+
+    def _restore_worker(self, work, budget, stop, errors):
+        """
+        Writer stage of restore: writes the items _queue_blob puts on work until it
+        takes None, reading pack and object files and large inline content directly.
+        Each thread has its own pack reader and database connection.
+        """
+        packs = _PackReader(self.packs_dir)
+        conn = self._connect()
+        made_dirs = set()
+        try:
+            while True:
+                item = work.get()
+                if item is None:
+                    break
+                out_path, offset, stored, mtime_ns = item
+                try:
+                    if stop.is_set():
+                        continue
+                    if offset is None:
+                        dir_path = os.path.dirname(out_path)
+                        if dir_path not in made_dirs:
+                            os.makedirs(dir_path, exist_ok=True)
+                            made_dirs.add(dir_path)
+                        with open(out_path, "wb") as f:
+                            self._write_stored(packs, f, *stored, conn=conn)
+                        if mtime_ns is not None:
+                            os.utime(out_path, ns=(mtime_ns, mtime_ns))
+                    else:
+                        with open(out_path, "r+b") as f:
+                            f.seek(offset)
+                            self._write_stored(packs, f, *stored, conn=conn)
+                finally:
+                    budget.release(0 if stored[1] is None else len(stored[1]))
+        except Exception as e:
+            errors.append(e)
+            stop.set()
+            while True:
+                item = work.get()
+                if item is None:
+                    break
+                budget.release(0 if item[2][1] is None else len(item[2][1]))
+        finally:
+            conn.close()
+            packs.close()
+
+    def _snapshot_files(self, cur, snapshot_id, root_tree):
+        """
+        Executes a single query over the files of a snapshot and returns the cursor,
+        which yields (path, dev, ino, blob_hash), the blobs row the file refers to:
+        (hash, content, codec, pack_id, pack_offset, stored_size, placement,
+        delta_base, size), all NULL if no blob is stored under the file's key (it is
+        missing, or in the other key form until migrate finishes), and then the
+        file's recorded (size, mtime_ns). Inline content larger than STREAM_CHUNK is
+        not read (content is NULL) and is left for _write_stored to stream.
+
+        The query runs in two steps. First the trees of the snapshot, or its file
+        rows if it has no root tree, are joined with the hash index of blobs, which
+        gives each file's blobs rowid without reading the table, and sorted by that
+        rowid: the sorter holds only paths, keys and row numbers. Then the blobs rows
+        are read in rowid order, which is the order they were written in and so also
+        the order of their content in pack files, and content is read sequentially.
+        Rows after the sort are produced as the cursor is iterated; the cursor must
+        not be used for other queries meanwhile.
+        """
+        columns = _streamed_blob_columns("b")
+        if root_tree is not None:
+            walk = '''WITH RECURSIVE walk(prefix, tree_hash) AS (
+                    SELECT '', ?
+                    UNION ALL
+                    SELECT w.prefix || t.name || '/', t.hash
+                    FROM walk w JOIN tree_entries t ON t.tree_hash = w.tree_hash AND t.kind = 'd'
+                ),'''
+            files = ("SELECT w.prefix || t.name AS path, t.dev, t.ino, t.hash AS blob_hash, t.size, t.mtime_ns "
+                     "FROM walk w JOIN tree_entries t ON t.tree_hash = w.tree_hash AND t.kind = 'f'")
+            params = (root_tree,)
+        else:
+            # The files view would walk the trees of every snapshot, so the tables
+            # that hold file rows are read directly.
+            walk = "WITH"
+            sources = []
+            for table in self._entry_tables():
+                if table == "entries":
+                    sources.append("SELECT CASE d.path WHEN '' THEN p.name ELSE d.path || '/' || p.name END "
+                                   "AS path, e.dev, e.ino, e.blob_hash, e.size, e.mtime_ns FROM entries e "
+                                   "JOIN paths p ON p.id = e.path_id JOIN dirs d ON d.id = p.dir_id "
+                                   "WHERE e.snapshot_id = ?")
+                else:
+                    sources.append(f"SELECT path, dev, ino, blob_hash, size, mtime_ns FROM {table} "
+                                   "WHERE snapshot_id = ?")
+            files = " UNION ALL ".join(sources)
+            params = (snapshot_id,) * len(sources)
+        # LIMIT keeps SQLite from dropping the ORDER BY of the subquery, which it then
+        # runs as a coroutine yielding rows in order.
+        if not self.shard_count:
+            cur.execute(f'''
+                {walk}
+                located AS (
+                    SELECT f.*, b.rowid AS row_id FROM ({files}) f LEFT JOIN blobs b ON b.hash = f.blob_hash
+                    ORDER BY row_id LIMIT -1
+                )
+                SELECT f.path, f.dev, f.ino, f.blob_hash, {columns}, f.size, f.mtime_ns
+                FROM located f LEFT JOIN blobs b ON b.rowid = f.row_id
+            ''', params)
+            return cur
+        # SQLite cannot push a join into the blobs view of a sharded repository and
+        # would read every shard in full, so each shard's table is joined directly.
+        schemas = [_shard_schema(index) for index in range(self.shard_count)]
+        lookups = " ".join(f"LEFT JOIN {schema}.blobs b{index} ON b{index}.hash = f.blob_hash"
+                           for index, schema in enumerate(schemas))
+        shard = " ".join(f"WHEN b{index}.rowid IS NOT NULL THEN {index}" for index in range(len(schemas)))
+        row_id = ", ".join(f"b{index}.rowid" for index in range(len(schemas)))
+        reads = [f"SELECT f.path, f.dev, f.ino, f.blob_hash, {columns}, f.size, f.mtime_ns "
+                 f"FROM located f JOIN {schema}.blobs b ON f.shard = {index} AND b.rowid = f.row_id"
+                 for index, schema in enumerate(schemas)]
+        reads.append(f"SELECT f.path, f.dev, f.ino, f.blob_hash, {', '.join(['NULL'] * 9)}, f.size, f.mtime_ns "
+                     "FROM located f WHERE f.row_id IS NULL")
+        cur.execute(f'''
+            {walk}
+            located AS (
+                SELECT f.*, CASE {shard} END AS shard, coalesce({row_id}, NULL) AS row_id
+                FROM ({files}) f {lookups}
+                ORDER BY shard, row_id LIMIT -1
+            )
+            {" UNION ALL ".join(reads)}
+        ''', params)
+        return cur
+
+    def _write_blob(self, cur, packs, blob_hash, f):
+        """
+        Writes the content of a blob to f, reading pack files through the _PackReader
+        packs. Returns None on success, or the hash of the blob or piece that is
+        missing from the database.
+        """
+        query = ("SELECT hash, content, codec, pack_id, pack_offset, stored_size, placement, delta_base "
+                 "FROM blobs WHERE hash IN (?, ?)")
+        cur.execute(query, self._key_forms(blob_hash))
+        row = cur.fetchone()
+        if not row:
+            return blob_hash
+        if row[7] is not None:
+            blob = self._blob_content(cur, packs, row[0])
+            if blob is None:
+                return row[7]
+            f.write(blob[0])
+            return None
+        if _placement(row[1], row[3], row[6]) != "pieces":
+            self._write_stored(packs, f, *row[:7])
+            return None
+        # Large blobs are reassembled piece by piece.
+        cur.execute("SELECT chunk_hash FROM chunks WHERE blob_hash = ? ORDER BY seq", (row[0],))
+        for (chunk_hash,) in cur.fetchall():
+            cur.execute(query, self._key_forms(chunk_hash))
+            piece = cur.fetchone()
+            if not piece:
+                return chunk_hash
+            self._write_stored(packs, f, *piece[:7])
+        return None
+
+    def _blob_content(self, cur, packs, blob_hash):
+        """
+        Returns (content, delta_depth) for a blob stored in one piece, applying its
+        chain of deltas, or None if it or a blob in its chain is missing or stored in
+        pieces.
+        """
+        chain = []
+        while blob_hash is not None:
+            cur.execute("SELECT hash, content, codec, pack_id, pack_offset, stored_size, placement, "
+                        "delta_base, delta_depth FROM blobs WHERE hash IN (?, ?)", self._key_forms(blob_hash))
+            row = cur.fetchone()
+            if not row or _placement(row[1], row[3], row[6]) == "pieces":
+                return None
+            chain.append(row)
+            blob_hash = row[7]
+        depth = chain[0][8] or 0
+        content = self._read_stored(packs, *chain.pop()[:7])
+        while chain:
+            content = _apply_delta(content, self._read_stored(packs, *chain.pop()[:7]))
+        return content, depth
+
+    def _read_stored(self, packs, stored_hash, content, codec, pack_id, pack_offset, stored_size, placement):
+        """Returns the decompressed content of one stored blob or piece."""
+        placement = _placement(content, pack_id, placement)
+        if placement == "inline":
+            return _decompress(content, codec)
+        if placement == "pack":
+            with packs.read(pack_id, pack_offset, stored_size) as stored:
+                return bytes(_decompress(stored, codec))
+        with open(_object_path(self.objects_dir, stored_hash), "rb") as src:
+            return _decompress(src.read(), codec)
+
+    def _write_stored(self, packs, f, stored_hash, content, codec, pack_id, pack_offset, stored_size, placement,
+                      conn=None):
+        """
+        Writes one stored blob or piece to f without holding more than STREAM_CHUNK
+        bytes of it in memory beyond content. Raw content in a pack or object file is
+        copied inside the kernel; compressed content is decompressed incrementally
+        from the pack's memory map or the object file. Inline content that was not
+        read (content None, see _snapshot_files) is streamed from the database
+        through conn with blobopen.
+        """
+        placement = _placement(content, pack_id, placement)
+        if placement == "inline":
+            if content is None:
+                self._write_inline(conn, f, stored_hash, codec)
+            else:
+                _write_chunks(f, _slices(content), codec)
+        elif placement == "pack":
+            if codec is None:
+                f.flush()
+                packs.copy(pack_id, pack_offset, stored_size, f.fileno())
+            else:
+                with packs.read(pack_id, pack_offset, stored_size) as stored:
+                    _write_chunks(f, _slices(stored), codec)
+        else:
+            with open(_object_path(self.objects_dir, stored_hash), "rb") as src:
+                if codec is None:
+                    f.flush()
+                    _copy_range(src.fileno(), f.fileno(), 0, stored_size)
+                else:
+                    _write_chunks(f, iter(lambda: src.read(STREAM_CHUNK), b""), codec)
+
+    def _write_inline(self, conn, f, stored_hash, codec):
+        """
+        Streams the content of a blob stored inline from the database to f.
+        Connection.blobopen is new in Python 3.11; older versions read the whole value
+        in one query. That is at most one piece for content stored in pieces, but a
+        whole file for a file stored inline by a v1 or v2 database. Reading it with
+        substr() would not help: SQLite loads the whole value for each call.
+        """
+        schema = self._blob_schema(stored_hash)
+        if not hasattr(conn, "blobopen"):
+            row = conn.execute(f"SELECT content FROM {schema}.blobs WHERE hash = ?", (stored_hash,)).fetchone()
+            _write_chunks(f, _slices(row[0]), codec)
+            return
+        row = conn.execute(f"SELECT rowid FROM {schema}.blobs WHERE hash = ?", (stored_hash,)).fetchone()
+        with conn.blobopen("blobs", "content", row[0], readonly=True, name=schema) as blob:
+            _write_chunks(f, iter(lambda: blob.read(STREAM_CHUNK), b""), codec)
+
+    def _key_forms(self, key):
+        """
+        Returns the pair of values to match a blob key against. Until migrate finishes,
+        a reference and the blob it points to may be in different forms (hex TEXT or
+        binary digest), so both are tried.
+        """
+        if self.schema_version >= 2:
+            return (key, key)
+        return (key, key.hex() if isinstance(key, bytes) else bytes.fromhex(key))
+
+    def _link(self, existing_path, out_path):
+        """Makes out_path a hard link to existing_path, returning False if that is not possible."""
+        try:
+            if os.path.lexists(out_path):
+                os.unlink(out_path)
+            os.link(existing_path, out_path)
+        except OSError:
+            return False
+        return True
+
+    def prune(self, snapshot_id):
+        """
+        Prunes (removes) snapshots with IDs less than or equal to snapshot_id.
+        After deletion, any blob not referenced by any remaining snapshot is removed.
+        This ensures that remaining snapshots are still fully restorable.
+
+        A snapshot stored as trees is one snapshots row, so dropping it costs the
+        same however many files it has; only snapshots not yet migrated to schema v5
+        have per-file rows to delete. Garbage collection only looks at what the
+        pruned snapshots referenced: each tree, blob, piece and path they used is
+        checked for remaining references through an index, and removed if it has
+        none, in which case the objects it referenced are checked in turn. Trees
+        shared with a remaining snapshot stop the descent, so the cost follows what
+        is deleted, not the repository size.
+
+        Prune waits for running snapshots to finish, and snapshots started while it
+        runs wait for it.
+        """
+        # A running snapshot may reuse any blob without having written the rows that
+        # reference it yet, so prune waits until none is running.
+        repository_lock = self._lock_repository(shared=False)
+        try:
+            cur = self.conn.cursor()
+            # Determine which snapshots will be pruned. Incomplete snapshots were
+            # interrupted, or are still being taken where there is no lock; they are
+            # left alone.
+            pruned = "SELECT id FROM snapshots WHERE id <= ? AND complete"
+            cur.execute(pruned, (snapshot_id,))
+            to_delete = [row[0] for row in cur.fetchall()]
+            if not to_delete:
+                print("No snapshots to prune.")
+                return
+            blobs, path_ids = set(), set()
+            tables = self._entry_tables()
+            # Remove file entries for pruned snapshots, remembering what they referenced.
+            for table in tables:
+                cur.execute(f"SELECT blob_hash FROM {table} WHERE snapshot_id IN ({pruned})", (snapshot_id,))
+                blobs.update(row[0] for row in cur.fetchall())
+                if table == "entries":
+                    cur.execute(f"SELECT path_id FROM entries WHERE snapshot_id IN ({pruned})", (snapshot_id,))
+                    path_ids.update(row[0] for row in cur.fetchall())
+                cur.execute(f"DELETE FROM {table} WHERE snapshot_id IN ({pruned})", (snapshot_id,))
+            # Remove the snapshot records.
+            cur.execute(f"SELECT root_tree FROM snapshots WHERE id IN ({pruned}) AND root_tree IS NOT NULL",
+                        (snapshot_id,))
+            trees = {row[0] for row in cur.fetchall()}
+            cur.execute(f"DELETE FROM snapshots WHERE id IN ({pruned})", (snapshot_id,))
+            # Remove trees no longer reached from a remaining snapshot or a remaining tree,
+            # top-down. A tree still referenced by a tree that is removed later is checked
+            # again then.
+            while trees:
+                tree_hash = trees.pop()
+                cur.execute("SELECT 1 FROM snapshots WHERE root_tree = ? "
+                            "UNION ALL SELECT 1 FROM tree_entries WHERE hash = ? AND kind = 'd' LIMIT 1",
+                            (tree_hash, tree_hash))
+                if cur.fetchone():
+                    continue
+                cur.execute("SELECT kind, hash FROM tree_entries WHERE tree_hash = ?", (tree_hash,))
+                for kind, obj_hash in cur.fetchall():
+                    (trees if kind == "d" else blobs).add(obj_hash)
+                cur.execute("DELETE FROM tree_entries WHERE tree_hash = ?", (tree_hash,))
+                cur.execute("DELETE FROM trees WHERE hash = ?", (tree_hash,))
+            # Remove blobs referenced neither by a remaining snapshot, a piece list nor a
+            # delta, along with the piece lists of large blobs, whose pieces are then
+            # checked, and the bases of deltas.
+            unused_objects, packs = [], set()
+            while blobs:
+                blob_hash = blobs.pop()
+                if self._blob_referenced(cur, tables, blob_hash):
+                    continue
+                cur.execute("SELECT hash, content, pack_id, placement, delta_base FROM blobs WHERE hash IN (?, ?)",
+                            self._key_forms(blob_hash))
+                row = cur.fetchone()
+                if not row:
+                    continue
+                stored_hash, content, pack_id, placement, delta_base = row
+                placement = _placement(content, pack_id, placement)
+                if delta_base is not None:
+                    blobs.add(delta_base)
+                if placement == "pieces":
+                    cur.execute("SELECT chunk_hash FROM chunks WHERE blob_hash = ?", (stored_hash,))
+                    blobs.update(r[0] for r in cur.fetchall())
+                    cur.execute(f"DELETE FROM {self._blob_schema(stored_hash)}.chunks WHERE blob_hash = ?",
+                                (stored_hash,))
+                elif placement == "object":
+                    unused_objects.append(stored_hash)
+                elif placement == "pack":
+                    packs.add(pack_id)
+                cur.execute(f"DELETE FROM {self._blob_schema(stored_hash)}.blobs WHERE hash = ?", (stored_hash,))
+            # Paths and directories that no remaining snapshot contains.
+            dir_ids = set()
+            for path_id in path_ids:
+                cur.execute("SELECT 1 FROM entries WHERE path_id = ? LIMIT 1", (path_id,))
+                if not cur.fetchone():
+                    cur.execute("SELECT dir_id FROM paths WHERE id = ?", (path_id,))
+                    dir_ids.update(row[0] for row in cur.fetchall())
+                    cur.execute("DELETE FROM paths WHERE id = ?", (path_id,))
+            for dir_id in dir_ids:
+                cur.execute("SELECT 1 FROM paths WHERE dir_id = ? LIMIT 1", (dir_id,))
+                if not cur.fetchone():
+                    cur.execute("DELETE FROM dirs WHERE id = ?", (dir_id,))
+            self.conn.commit()
+            # Object files are removed only once their rows are gone for good.
+            for blob_hash in unused_objects:
+                try:
+                    os.remove(_object_path(self.objects_dir, blob_hash))
+                except FileNotFoundError:
+                    pass
+            # Pack files are append-only; a pack is deleted once none of its blobs is left.
+            # A snapshot appending to packs may have written to one whose rows it has not
+            # committed yet, so deletion waits for the pack lock it holds (see _PackWriter),
+            # and the newest pack is kept for the next snapshot to append to.
+            if packs:
+                with _lock_file(os.path.join(self.packs_dir, "lock")):
+                    pack_ids = _pack_ids(self.packs_dir)
+                    for pack_id in packs:
+                        cur.execute("SELECT 1 FROM blobs WHERE pack_id = ? LIMIT 1", (pack_id,))
+                        if pack_id in pack_ids[:-1] and not cur.fetchone():
+                            os.remove(_pack_path(self.packs_dir, pack_id))
+            print(f"Pruned snapshots: {to_delete}")
+        finally:
+            repository_lock.close()
+
+    def _blob_referenced(self, cur, tables, blob_hash):
+        """
+        Returns whether a remaining row of the file entry tables, a tree, a piece
+        list or a delta references the blob. Every lookup is served by an index.
+        """
+        keys = self._key_forms(blob_hash)
+        queries = [f"SELECT 1 FROM {table} WHERE blob_hash IN (?, ?)" for table in tables]
+        queries.append("SELECT 1 FROM chunks WHERE chunk_hash IN (?, ?)")
+        queries.append("SELECT 1 FROM blobs WHERE delta_base IN (?, ?)")
+        if self.normalized:
+            queries.append("SELECT 1 FROM tree_entries WHERE hash IN (?, ?) AND kind = 'f'")
+        cur.execute(" UNION ALL ".join(queries) + " LIMIT 1", keys * len(queries))
+        return cur.fetchone() is not None
+
+    def _entry_tables(self):
+        """Returns the tables that hold file rows: entries and/or the pre-v3 files table."""
+        cur = self.conn.cursor()
+        cur.execute("SELECT name FROM sqlite_master WHERE type = 'table' "
+                    "AND name IN ('entries', 'files', 'files_v2')")
+        return [row[0] for row in cur.fetchall()]
+
+    def migrate(self, batch_size=MIGRATE_BATCH):
+        """
+        Converts the database to SCHEMA_VERSION one version at a time, recording each
+        step in PRAGMA user_version:
+
+        v1 to v2 rewrites blob keys from 64-character hex TEXT to 32-byte binary
+        digests. v2 to v3 moves the rows of the files table, which stores every full
+        path in every snapshot, into entries with interned paths. v3 to v4 adds the
+        tree tables used by new snapshots. v4 to v5 converts the entries of each
+        snapshot into trees, after which dropping a snapshot deletes one row.
+
+        Rows are converted batch_size per transaction and the old rows are removed as
+        they are converted, so the database never needs twice its size and other
+        processes wait for at most one batch. Every command works on a partly
+        converted database, and an interrupted migration resumes where it stopped.
+        """
+        if self.schema_version >= SCHEMA_VERSION:
+            print(f"Database is already at schema v{self.schema_version}.")
+            return
+        if self.schema_version < 2:
+            # Repeat until a full pass finds nothing, in case a concurrent snapshot
+            # copied a hex reference forward from an unconverted row.
+            while True:
+                blobs = self._migrate_blob_keys(batch_size)
+                files = self._migrate_key_column("files", "blob_hash", batch_size)
+                pieces = self._migrate_key_column("chunks", "chunk_hash", batch_size)
+                print(f"Converted {blobs} blob keys, {files} file references, {pieces} piece references")
+                if not blobs + files + pieces:
+                    break
+            self._set_schema_version(2)
+        if self.schema_version < 3:
+            print(f"Moved {self._migrate_paths(batch_size)} file rows to interned paths")
+            self._set_schema_version(3)
+        if self.schema_version < 4:
+            self._create_path_tables(self.conn.cursor())
+            self._set_schema_version(4)
+        if self.schema_version < 5:
+            print(f"Converted {self._migrate_entries_to_trees(batch_size)} snapshots to trees")
+            self._set_schema_version(5)
+        print(f"Database migrated to schema v{SCHEMA_VERSION}.")
+
+    def _set_schema_version(self, version):
+        self.conn.execute(f"PRAGMA user_version = {version}")
+        self.conn.commit()
+        self.schema_version = version
+
+    def _migrate_paths(self, batch_size):
+        """
+        Moves rows from the pre-v3 files table into entries, interning their paths.
+        The table is first renamed to files_v2 and the files view covers both tables,
+        so each row is visible exactly once throughout. Returns the rows moved.
+        """
+        cur = self.conn.cursor()
+        if not self.normalized:
+            cur.execute("ALTER TABLE files RENAME TO files_v2")
+            self._create_path_tables(cur, legacy_table="files_v2")
+            self._create_indexes(cur)
+            self.conn.commit()
+            self.normalized = True
+        paths = _PathIndex(self.conn)
+        moved = 0
+        while True:
+            cur.execute(
+                "SELECT rowid, snapshot_id, path, blob_hash, dev, ino, size, mtime_ns, ctime_ns "
+                "FROM files_v2 ORDER BY rowid LIMIT ?",
+                (batch_size,)
+            )
+            rows = cur.fetchall()
+            if not rows:
+                break
+            cur.executemany(
+                "INSERT OR REPLACE INTO entries (snapshot_id, path_id, blob_hash, dev, ino, size, mtime_ns, ctime_ns) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [(row[1], paths.intern(row[2])) + row[3:] for row in rows]
+            )
+            cur.execute("DELETE FROM files_v2 WHERE rowid <= ?", (rows[-1][0],))
+            self.conn.commit()
+            moved += len(rows)
+        self._create_path_tables(cur)
+        cur.execute("DROP TABLE files_v2")
+        self.conn.commit()
+        return moved
 
-    def restore(self, snapshot_id, output_directory):
+    def _migrate_entries_to_trees(self, batch_size):
         """
-        Restores the state of a directory from the snapshot identified by snapshot_id.
-        The directory structure and file contents are re-created exactly as stored.
+        Stores the entries of each snapshot that has no root tree as trees and
+        records its root tree, committing every batch_size tree entries. Once a
+        snapshot has its root tree its entries are ignored, and when all snapshots
+        are converted the entries, paths and dirs rows are deleted batch by batch.
+        Returns the number of snapshots converted.
         """
         cur = self.conn.cursor()
-        # Check if snapshot exists
-        cur.execute("SELECT id FROM snapshots WHERE id = ?", (snapshot_id,))
-        if not cur.fetchone():
-            print(f"Snapshot {snapshot_id} not found.")
-            return
+        cur.execute("SELECT id FROM snapshots WHERE root_tree IS NULL AND complete ORDER BY id")
+        snapshot_ids = [row[0] for row in cur.fetchall()]
+        for snapshot_id in snapshot_ids:
+            tree_rows, entry_rows = [], []
 
-        if not os.path.exists(output_directory):
-            os.makedirs(output_directory)
+            def on_tree(tree_hash, entries):
+                tree_rows.append((tree_hash,))
+                entry_rows.extend((tree_hash,) + entry for entry in entries)
+                if len(entry_rows) >= batch_size:
+                    _insert_tree_rows(cur, tree_rows, entry_rows)
+                    self.conn.commit()
+                    tree_rows.clear()
+                    entry_rows.clear()
 
-        cur.execute("SELECT path, blob_hash FROM files WHERE snapshot_id = ?", (snapshot_id,))
-        rows = cur.fetchall()
-        for path, blob_hash in rows:
-            out_path = os.path.join(output_directory, path)
-            os.makedirs(os.path.dirname(out_path), exist_ok=True)
-            cur.execute("SELECT content FROM blobs WHERE hash = ?", (blob_hash,))
-            blob_row = cur.fetchone()
-            if not blob_row:
-                print(f"Error: missing blob {blob_hash} for file {path}")
-                continue
-            with open(out_path, "wb") as f:
-                f.write(blob_row[0])
-        print(f"Snapshot {snapshot_id} restored to {output_directory}")
+            trees = _TreeBuilder(on_tree)
+            # Entries only list files, so directories and their entry counts (files
+            # plus subdirectories) are derived from the paths. Rows come depth first
+            # (with '/' sorting before any other character, a directory's subtree
+            # follows it directly), so a directory is complete as soon as rows leave
+            # its subtree, and only the directories on the current path are open.
+            rows = self.conn.cursor()
+            rows.execute(
+                "SELECT d.path, p.name, e.blob_hash, e.dev, e.ino, e.size, e.mtime_ns, e.ctime_ns "
+                "FROM entries e JOIN paths p ON p.id = e.path_id JOIN dirs d ON d.id = p.dir_id "
+                "WHERE e.snapshot_id = ? ORDER BY replace(d.path, '/', char(1))",
+                (snapshot_id,)
+            )
+            # [dir_path, entry count] for each open directory, from the root down.
+            open_dirs = [["", 0]]
+            for dir_path, name, *entry in rows:
+                if dir_path != open_dirs[-1][0]:
+                    while open_dirs[-1][0] and not dir_path.startswith(open_dirs[-1][0] + "/"):
+                        trees.listed(*open_dirs.pop())
+                    parent = open_dirs[-1][0]
+                    rest = dir_path[len(parent) + 1:] if parent else dir_path
+                    for part in rest.split("/"):
+                        open_dirs[-1][1] += 1
+                        open_dirs.append([os.path.join(open_dirs[-1][0], part), 0])
+                trees.add(os.path.join(dir_path, name), ("f",) + tuple(entry))
+                open_dirs[-1][1] += 1
+            while open_dirs:
+                trees.listed(*open_dirs.pop())
+            _insert_tree_rows(cur, tree_rows, entry_rows)
+            cur.execute("UPDATE snapshots SET root_tree = ? WHERE id = ?", (trees.root, snapshot_id))
+            self.conn.commit()
+        for table, key in [("entries", "snapshot_id, path_id"), ("paths", "id"), ("dirs", "id")]:
+            while True:
+                cur.execute(f"DELETE FROM {table} WHERE ({key}) IN (SELECT {key} FROM {table} LIMIT ?)",
+                            (batch_size,))
+                self.conn.commit()
+                if cur.rowcount < batch_size:
+                    break
+        return len(snapshot_ids)
 
-    def prune(self, snapshot_id):
+    def _migrate_blob_keys(self, batch_size):
         """
-        Prunes (removes) snapshots with IDs less than or equal to snapshot_id.
-        After deletion, any blob not referenced by any remaining snapshot is removed.
-        This ensures that remaining snapshots are still fully restorable.
+        Converts hex blob keys to binary, along with the parent key of their piece
+        lists so each blob stays consistent with its list. Returns the rows converted.
         """
         cur = self.conn.cursor()
-        # Determine which snapshots will be pruned.
-        cur.execute("SELECT id FROM snapshots WHERE id <= ?", (snapshot_id,))
-        to_delete = [row[0] for row in cur.fetchall()]
-        if not to_delete:
-            print("No snapshots to prune.")
-            return
-        # Remove file entries for pruned snapshots.
-        cur.execute("DELETE FROM files WHERE snapshot_id <= ?", (snapshot_id,))
-        # Remove the snapshot records.
-        cur.execute("DELETE FROM snapshots WHERE id <= ?", (snapshot_id,))
-        # Remove any blobs not referenced by any remaining snapshot.
-        cur.execute("DELETE FROM blobs WHERE hash NOT IN (SELECT DISTINCT blob_hash FROM files)")
-        self.conn.commit()
-        print(f"Pruned snapshots: {to_delete}")
+        converted = 0
+        last_rowid = 0
+        while True:
+            cur.execute(
+                "SELECT rowid, hash FROM blobs WHERE rowid > ? AND typeof(hash) = 'text' "
+                "ORDER BY rowid LIMIT ?",
+                (last_rowid, batch_size)
+            )
+            rows = cur.fetchall()
+            if not rows:
+                return converted
+            for rowid, hex_hash in rows:
+                digest = bytes.fromhex(hex_hash)
+                cur.execute("SELECT 1 FROM blobs WHERE hash = ?", (digest,))
+                if cur.fetchone():
+                    # The content was stored again under its binary key after this
+                    # database was first opened by a v2-aware version; keep that copy.
+                    cur.execute("DELETE FROM blobs WHERE rowid = ?", (rowid,))
+                    cur.execute("DELETE FROM chunks WHERE blob_hash = ?", (hex_hash,))
+                else:
+                    cur.execute("UPDATE blobs SET hash = ? WHERE rowid = ?", (digest, rowid))
+                    cur.execute("UPDATE chunks SET blob_hash = ? WHERE blob_hash = ?", (digest, hex_hash))
+            self.conn.commit()
+            converted += len(rows)
+            last_rowid = rows[-1][0]
+
+    def _migrate_key_column(self, table, column, batch_size):
+        """Converts hex references in table.column to binary. Returns the rows converted."""
+        cur = self.conn.cursor()
+        converted = 0
+        last_rowid = 0
+        while True:
+            cur.execute(
+                f"SELECT rowid, {column} FROM {table} WHERE rowid > ? AND typeof({column}) = 'text' "
+                f"ORDER BY rowid LIMIT ?",
+                (last_rowid, batch_size)
+            )
+            rows = cur.fetchall()
+            if not rows:
+                return converted
+            cur.executemany(
+                f"UPDATE {table} SET {column} = ? WHERE rowid = ?",
+                [(bytes.fromhex(value), rowid) for rowid, value in rows]
+            )
+            self.conn.commit()
+            converted += len(rows)
+            last_rowid = rows[-1][0]
 
     def close(self):
         """Closes the database connection."""
@@ -162,20 +2884,85 @@ class BackupTool:
 def main():
     parser = argparse.ArgumentParser(description="Backup Tool")
     parser.add_argument("--db", default=".backuptool.db", help="Path to database file")
+    parser.add_argument("--shards", type=int, default=0,
+                        help="When creating a repository, split blob storage across this many "
+                             f"database files (at most {MAX_SHARDS}); ignored for an existing one")
+    parser.add_argument("--repo-format", choices=["db", "objects"], default="db",
+                        help="When creating a repository, store content in the database or as one "
+                             "file per blob under <db>.store/objects; ignored for an existing one")
     subparsers = parser.add_subparsers(dest="command")
 
     snapshot_parser = subparsers.add_parser("snapshot", help="Take a snapshot of a directory")
     snapshot_parser.add_argument("--target-directory", required=True, help="Directory to snapshot")
+    snapshot_parser.add_argument("--rehash", action="store_true",
+                                 help="Read and hash every file, even if its metadata is unchanged")
+    snapshot_parser.add_argument("--chunking", choices=["fixed", "cdc"], default="fixed",
+                                 help="Split files into fixed-size pieces or content-defined chunks. "
+                                      "Finding chunk boundaries runs at about 6 MB/s per reader thread")
+    snapshot_parser.add_argument("--chunk-min", type=int, default=256 * 1024,
+                                 help="Minimum chunk size in bytes for --chunking=cdc")
+    snapshot_parser.add_argument("--chunk-avg", type=int, default=1024 * 1024,
+                                 help="Target average chunk size in bytes for --chunking=cdc")
+    snapshot_parser.add_argument("--chunk-max", type=int, default=CHUNK_SIZE,
+                                 help="Maximum chunk size in bytes for --chunking=cdc")
+    snapshot_parser.add_argument("--cdc-min-file-size", type=int, default=CDC_MIN_FILE_SIZE,
+                                 help="With --chunking=cdc, split smaller files into fixed-size pieces")
+    snapshot_parser.add_argument("--jobs", type=int, default=DEFAULT_JOBS,
+                                 help="Number of reader/hasher threads")
+    snapshot_parser.add_argument("--commit-rows", type=int, default=COMMIT_ROWS,
+                                 help="Commit after this many buffered rows")
+    snapshot_parser.add_argument("--commit-bytes", type=int, default=COMMIT_BYTES,
+                                 help="Commit after this many bytes of buffered content")
+    snapshot_parser.add_argument("--compression", choices=sorted(CODECS),
+                                 help="Compress new content with this codec (default: store raw)")
+    snapshot_parser.add_argument("--compression-level", type=int,
+                                 help="Codec compression level (zlib/lzma 0-9, bz2 1-9)")
+    snapshot_parser.add_argument("--storage", choices=["db", "pack", "object"],
+                                 help="Store new content in the database, or place content of at least "
+                                      "--inline-threshold bytes in pack files or one file per blob beside it "
+                                      "(default: object for an objects repository, otherwise db)")
+    snapshot_parser.add_argument("--inline-threshold", type=int,
+                                 help="With --storage=pack/object, keep smaller blobs in the database "
+                                      f"(default: 0 for an objects repository, otherwise {INLINE_THRESHOLD})")
+    snapshot_parser.add_argument("--pack-size", type=int, default=PACK_SIZE,
+                                 help="Start a new pack file once one reaches this many bytes")
+    snapshot_parser.add_argument("--delta", action="store_true",
+                                 help="Store changed files as deltas against their previous version "
+                                      "when that is much smaller")
+    snapshot_parser.add_argument("--exclude", dest="rules", action=_RuleAction, metavar="PATTERN",
+                                 help="Exclude matching files and directories (repeatable). Rules are "
+                                      "checked in command-line order and the first match decides")
+    snapshot_parser.add_argument("--include", dest="rules", action=_RuleAction, metavar="PATTERN",
+                                 help="Include matching entries that a later --exclude would match (repeatable)")
+    snapshot_parser.add_argument("--exclude-from", dest="rules", action=_RuleAction, metavar="FILE",
+                                 help="Read exclude patterns from FILE, one per line; '#' starts a comment")
 
     list_parser = subparsers.add_parser("list", help="List snapshots")
 
     restore_parser = subparsers.add_parser("restore", help="Restore a snapshot to a directory")
     restore_parser.add_argument("--snapshot-number", type=int, required=True, help="Snapshot number to restore")
     restore_parser.add_argument("--output-directory", required=True, help="Directory to restore files into")
+    restore_parser.add_argument("--hardlinks", action="store_true",
+                                help="Recreate hard links between files that shared an inode")
+    restore_parser.add_argument("--jobs", type=int, default=DEFAULT_JOBS,
+                                help="Number of file writer threads")
+    restore_parser.add_argument("--incremental", action="store_true",
+                                help="Keep files in the output directory that match the snapshot by "
+                                     "size and mtime, or by content hash, and write only the rest")
+    restore_parser.add_argument("--dedup", choices=["reflink", "hardlink", "copy"],
+                                help="Write the content of each blob once and create the other files "
+                                     "with it as reflinks, hard links or copies of the first")
+    restore_parser.add_argument("--delete", action="store_true",
+                                help="Delete files and directories in the output directory that are "
+                                     "not in the snapshot")
 
     prune_parser = subparsers.add_parser("prune", help="Prune snapshots up to a given snapshot")
     prune_parser.add_argument("--snapshot", type=int, required=True, help="Prune all snapshots with id <= this number")
 
+    migrate_parser = subparsers.add_parser("migrate", help="Convert the database to the current schema")
+    migrate_parser.add_argument("--batch-size", type=int, default=MIGRATE_BATCH,
+                                help="Rows converted per transaction")
+
     test_parser = subparsers.add_parser("test", help="Run automated tests")
 
     args = parser.parse_args()
@@ -184,15 +2971,48 @@ def main():
         run_tests()
         return
 
-    tool = BackupTool(args.db)
+    chunker = None
+    if not 0 <= args.shards <= MAX_SHARDS:
+        parser.error(f"--shards must be between 0 and {MAX_SHARDS}")
+    if args.command in ("snapshot", "restore") and args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    if args.command == "snapshot" and args.pack_size < 1:
+        parser.error("--pack-size must be at least 1")
+    if args.command == "snapshot" and args.inline_threshold is not None and args.inline_threshold < 0:
+        parser.error("--inline-threshold must not be negative")
+    if args.command == "snapshot" and args.compression_level is not None:
+        if args.compression is None:
+            parser.error("--compression-level requires --compression")
+        if args.compression_level not in CODECS[args.compression][3]:
+            parser.error(f"invalid --compression-level for {args.compression}")
+    if args.command == "snapshot" and args.chunking == "cdc":
+        if args.cdc_min_file_size < 0:
+            parser.error("--cdc-min-file-size must not be negative")
+        try:
+            chunker = FastCDC(args.chunk_min, args.chunk_avg, args.chunk_max, args.cdc_min_file_size)
+        except ValueError as e:
+            parser.error(str(e))
+
+    tool = BackupTool(args.db, shards=args.shards, repo_format=args.repo_format)
+    if tool.schema_version < SCHEMA_VERSION and args.command != "migrate":
+        print(f"Note: database schema is v{tool.schema_version}; run 'migrate' to convert it "
+              f"to v{SCHEMA_VERSION}.")
     if args.command == "snapshot":
-        tool.snapshot(args.target_directory)
+        path_filter = PathFilter(args.rules) if args.rules else None
+        tool.snapshot(args.target_directory, rehash=args.rehash, chunker=chunker, jobs=args.jobs,
+                      commit_rows=args.commit_rows, commit_bytes=args.commit_bytes,
+                      path_filter=path_filter, compression=args.compression,
+                      compression_level=args.compression_level, storage=args.storage,
+                      pack_size=args.pack_size, inline_threshold=args.inline_threshold, delta=args.delta)
     elif args.command == "list":
         tool.list_snapshots()
     elif args.command == "restore":
-        tool.restore(args.snapshot_number, args.output_directory)
+        tool.restore(args.snapshot_number, args.output_directory, hardlinks=args.hardlinks, jobs=args.jobs,
+                     incremental=args.incremental, delete=args.delete, dedup=args.dedup)
     elif args.command == "prune":
         tool.prune(args.snapshot)
+    elif args.command == "migrate":
+        tool.migrate(args.batch_size)
     else:
         parser.print_help()
     tool.close()
@@ -201,7 +3021,9 @@ def main():
 # Automated tests using unittest
 # ----------------------------
 import unittest
+import unittest.mock
 import tempfile
+import io
 import filecmp
 
 class TestBackupTool(unittest.TestCase):
@@ -250,6 +3072,984 @@ class TestBackupTool(unittest.TestCase):
             # Blob count should remain the same.
             self.assertEqual(count1, count2)
 
+    def test_unchanged_files_not_reread(self):
+        # A file whose stat metadata is unchanged reuses the previous blob hash
+        # without being read, unless a rehash is requested.
+        with tempfile.TemporaryDirectory() as tmp_src, tempfile.NamedTemporaryFile(delete=False) as tmp_db:
+            file1 = os.path.join(tmp_src, "file1.txt")
+            with open(file1, "w") as f:
+                f.write("Unchanged")
+            tool = BackupTool(tmp_db.name)
+            tool.snapshot(tmp_src)
+            self.assertEqual(tool.stats["read"], 1)
+            tool.snapshot(tmp_src)
+            self.assertEqual((tool.stats["read"], tool.stats["unchanged"]), (0, 1))
+            tool.snapshot(tmp_src, rehash=True)
+            self.assertEqual(tool.stats["read"], 1)
+            cur = tool.conn.cursor()
+            cur.execute("SELECT COUNT(DISTINCT blob_hash) FROM files")
+            self.assertEqual(cur.fetchone()[0], 1)
+            tool.close()
+
+    def test_large_file_stored_in_pieces(self):
+        # Files larger than CHUNK_SIZE are stored as a list of pieces and reassembled on restore.
+        with tempfile.TemporaryDirectory() as tmp_src, tempfile.TemporaryDirectory() as tmp_dst, tempfile.NamedTemporaryFile(delete=False) as tmp_db:
+            big = os.path.join(tmp_src, "big.bin")
+            piece = os.urandom(CHUNK_SIZE)
+            with open(big, "wb") as f:
+                f.write(piece + piece + b"tail")
+            tool = BackupTool(tmp_db.name)
+            tool.snapshot(tmp_src)
+            cur = tool.conn.cursor()
+            cur.execute("SELECT COUNT(*), COUNT(DISTINCT chunk_hash) FROM chunks")
+            self.assertEqual(cur.fetchone(), (3, 2))
+            restore_dir = os.path.join(tmp_dst, "restore")
+            tool.restore(1, restore_dir)
+            tool.close()
+            self.assertTrue(filecmp.cmp(big, os.path.join(restore_dir, "big.bin"), shallow=False))
+
+    def test_content_defined_chunking(self):
+        # Inserting bytes near the start of a file only adds the chunks around the edit.
+        with tempfile.TemporaryDirectory() as tmp_src, tempfile.TemporaryDirectory() as tmp_dst, tempfile.NamedTemporaryFile(delete=False) as tmp_db:
+            path = os.path.join(tmp_src, "data.bin")
+            data = os.urandom(256 * 1024)
+            with open(path, "wb") as f:
+                f.write(data)
+            chunker = FastCDC(min_size=2048, avg_size=8192, max_size=32768, min_file_size=0)
+            tool = BackupTool(tmp_db.name)
+            tool.snapshot(tmp_src, chunker=chunker)
+            cur = tool.conn.cursor()
+            cur.execute("SELECT COUNT(*) FROM chunks")
+            chunk_count = cur.fetchone()[0]
+            self.assertGreater(chunk_count, 4)
+            with open(path, "wb") as f:
+                f.write(data[:1000] + b"inserted" + data[1000:])
+            tool.snapshot(tmp_src, chunker=chunker)
+            cur.execute("SELECT COUNT(DISTINCT chunk_hash) FROM chunks")
+            self.assertLessEqual(cur.fetchone()[0], chunk_count + 2)
+            restore_dir = os.path.join(tmp_dst, "restore")
+            tool.restore(2, restore_dir)
+            self.assertTrue(filecmp.cmp(path, os.path.join(restore_dir, "data.bin"), shallow=False))
+
+            # Files below min_file_size take the fixed-piece path: this one fits in one.
+            with open(path, "ab") as f:
+                f.write(b"appended")
+            cur.execute("SELECT COUNT(*) FROM chunks")
+            chunk_count = cur.fetchone()[0]
+            tool.snapshot(tmp_src, chunker=FastCDC(min_size=2048, avg_size=8192, max_size=32768,
+                                                   min_file_size=len(data) + 100))
+            cur.execute("SELECT COUNT(*) FROM chunks")
+            self.assertEqual(cur.fetchone()[0], chunk_count)
+            tool.close()
+
+    def test_parallel_snapshot(self):
+        # Many files read by several reader threads restore to an identical tree.
+        with tempfile.TemporaryDirectory() as tmp_src, tempfile.TemporaryDirectory() as tmp_dst, tempfile.NamedTemporaryFile(delete=False) as tmp_db:
+            for i in range(40):
+                subdir = os.path.join(tmp_src, f"dir{i % 5}")
+                os.makedirs(subdir, exist_ok=True)
+                with open(os.path.join(subdir, f"file{i}.bin"), "wb") as f:
+                    f.write(os.urandom(i * 100))
+            tool = BackupTool(tmp_db.name)
+            tool.snapshot(tmp_src, jobs=4)
+            self.assertEqual(tool.stats["files"], 40)
+            restore_dir = os.path.join(tmp_dst, "restore")
+            tool.restore(1, restore_dir)
+            tool.close()
+            for i in range(40):
+                rel_path = os.path.join(f"dir{i % 5}", f"file{i}.bin")
+                self.assertTrue(filecmp.cmp(os.path.join(tmp_src, rel_path),
+                                            os.path.join(restore_dir, rel_path), shallow=False))
+
+    def test_parallel_restore(self):
+        # Several writer threads with a small in-flight budget restore whole files and
+        # pieces written at their offsets, and a writer error ends the restore.
+        with tempfile.TemporaryDirectory() as tmp_src, tempfile.TemporaryDirectory() as tmp_dst, tempfile.NamedTemporaryFile(delete=False) as tmp_db:
+            names = []
+            for i in range(30):
+                names.append(os.path.join(f"dir{i % 3}", f"file{i}.bin"))
+                os.makedirs(os.path.join(tmp_src, f"dir{i % 3}"), exist_ok=True)
+                with open(os.path.join(tmp_src, names[-1]), "wb") as f:
+                    f.write(os.urandom(i * 500) + bytes(i * 500))
+            tool = BackupTool(tmp_db.name)
+            self.addCleanup(shutil.rmtree, tmp_db.name + ".store", True)
+            with unittest.mock.patch.object(sys.modules[__name__], "CHUNK_SIZE", 3000):
+                tool.snapshot(tmp_src, compression="zlib", storage="pack", inline_threshold=2000)
+            restore_dir = os.path.join(tmp_dst, "restore")
+            tool.restore(1, restore_dir, jobs=4, buffer_bytes=5000)
+            for name in names:
+                self.assertTrue(filecmp.cmp(os.path.join(tmp_src, name), os.path.join(restore_dir, name),
+                                            shallow=False))
+
+            blocked_dir = os.path.join(tmp_dst, "blocked")
+            os.makedirs(blocked_dir)
+            open(os.path.join(blocked_dir, "dir1"), "w").close()
+            with self.assertRaises(OSError):
+                tool.restore(1, blocked_dir, jobs=4, buffer_bytes=5000)
+            tool.close()
+
+    def test_restore_streams_in_storage_order(self):
+        # Restore reads a snapshot with one query that yields its files in storage
+        # order, instead of one lookup per file.
+        with tempfile.TemporaryDirectory() as tmp_src, tempfile.TemporaryDirectory() as tmp_dst, tempfile.NamedTemporaryFile(delete=False) as tmp_db:
+            for i in range(50):
+                os.makedirs(os.path.join(tmp_src, f"dir{i % 5}"), exist_ok=True)
+                with open(os.path.join(tmp_src, f"dir{i % 5}", f"file{i}.bin"), "wb") as f:
+                    f.write(os.urandom(100 + i))
+            tool = BackupTool(tmp_db.name)
+            self.addCleanup(shutil.rmtree, tmp_db.name + ".store", True)
+            tool.snapshot(tmp_src, storage="pack", inline_threshold=0, jobs=4)
+            cur = tool.conn.cursor()
+            cur.execute("SELECT root_tree FROM snapshots WHERE id = 1")
+            statements = []
+            tool.conn.set_trace_callback(statements.append)
+            rows = tool._snapshot_files(tool.conn.cursor(), 1, cur.fetchone()[0])
+            tool.conn.set_trace_callback(None)
+            positions = [(row[7], row[8]) for row in rows]
+            self.assertEqual(len(positions), 50)
+            self.assertEqual(positions, sorted(positions))
+            # Files are sorted before blobs rows are read, which the hash index alone
+            # locates, so no content passes through the sorter.
+            cur.execute("EXPLAIN QUERY PLAN " + statements[-1])
+            plan = cur.fetchall()
+            self.assertTrue(any("COVERING INDEX" in row[3] for row in plan))
+            self.assertFalse([row for row in plan if row[1] == 0 and "TEMP B-TREE" in row[3]])
+
+            statements = []
+            tool.conn.set_trace_callback(statements.append)
+            tool.restore(1, os.path.join(tmp_dst, "restore"), jobs=2)
+            tool.conn.set_trace_callback(None)
+            tool.close()
+            self.assertLess(sum(1 for statement in statements if "SELECT" in statement), 5)
+            for i in range(50):
+                rel_path = os.path.join(f"dir{i % 5}", f"file{i}.bin")
+                self.assertTrue(filecmp.cmp(os.path.join(tmp_src, rel_path),
+                                            os.path.join(tmp_dst, "restore", rel_path), shallow=False))
+
+    def test_streaming_restore(self):
+        # Content larger than STREAM_CHUNK restores intact when streamed: inline
+        # content through blobopen, compressed content through incremental
+        # decompression, for every codec and placement.
+        with tempfile.TemporaryDirectory() as tmp_src, tempfile.TemporaryDirectory() as tmp_dst, tempfile.NamedTemporaryFile(delete=False) as tmp_db:
+            tool = BackupTool(tmp_db.name)
+            self.addCleanup(shutil.rmtree, tmp_db.name + ".store", True)
+            names = []
+            for codec in [None, "zlib", "bz2", "lzma"]:
+                for storage in ["db", "pack", "object"]:
+                    name = f"{codec}-{storage}.txt"
+                    with open(os.path.join(tmp_src, name), "w") as f:
+                        f.write(f"{codec} {storage} " + "".join(f"line {os.urandom(4).hex()}\n" for _ in range(2000)))
+                    names.append(name)
+                    tool.snapshot(tmp_src, compression=codec, storage=storage, inline_threshold=0)
+            cur = tool.conn.cursor()
+            cur.execute("SELECT COUNT(*) FROM blobs WHERE codec IS NOT NULL AND length(content) > 1000")
+            self.assertEqual(cur.fetchone()[0], 3)
+            restore_dir = os.path.join(tmp_dst, "restore")
+            with unittest.mock.patch.object(sys.modules[__name__], "STREAM_CHUNK", 1000), \
+                    unittest.mock.patch.object(BackupTool, "_write_inline", autospec=True,
+                                               side_effect=BackupTool._write_inline) as write_inline:
+                tool.restore(12, restore_dir, jobs=2)
+            self.assertEqual(write_inline.call_count, 4)
+
+            # Without Connection.blobopen (Python before 3.11) the value is read whole.
+            class OldConnection:
+                def __init__(self, conn):
+                    self.execute = conn.execute
+
+            cur.execute("SELECT hash, codec FROM blobs WHERE length(content) > 1000")
+            packs = _PackReader(tool.packs_dir)
+            for blob_hash, codec in cur.fetchall():
+                out = io.BytesIO()
+                tool._write_inline(OldConnection(tool.conn), out, blob_hash, codec)
+                self.assertEqual(out.getvalue(), tool._blob_content(tool.conn.cursor(), packs, blob_hash)[0])
+            packs.close()
+            tool.close()
+            for name in names:
+                self.assertTrue(filecmp.cmp(os.path.join(tmp_src, name), os.path.join(restore_dir, name),
+                                            shallow=False))
+
+    def test_incremental_restore(self):
+        # An incremental restore keeps files that match by size and mtime or by hash,
+        # rewrites the rest, and with delete removes what the snapshot does not have.
+        with tempfile.TemporaryDirectory() as tmp_src, tempfile.TemporaryDirectory() as tmp_dst, tempfile.NamedTemporaryFile(delete=False) as tmp_db:
+            os.makedirs(os.path.join(tmp_src, "dir"))
+            contents = {"same.txt": b"same", "touched.txt": b"touched", "edited.txt": b"edited",
+                        "removed.txt": b"removed", os.path.join("dir", "big.bin"): os.urandom(10000),
+                        os.path.join("dir", "replaced"): b"file, not a directory"}
+            for name, content in contents.items():
+                with open(os.path.join(tmp_src, name), "wb") as f:
+                    f.write(content)
+            tool = BackupTool(tmp_db.name)
+            self.addCleanup(shutil.rmtree, tmp_db.name + ".store", True)
+            with unittest.mock.patch.object(sys.modules[__name__], "CHUNK_SIZE", 3000):
+                tool.snapshot(tmp_src)
+            restore_dir = os.path.join(tmp_dst, "restore")
+            tool.restore(1, restore_dir)
+            for name in contents:
+                self.assertEqual(os.stat(os.path.join(restore_dir, name)).st_mtime_ns,
+                                 os.stat(os.path.join(tmp_src, name)).st_mtime_ns)
+
+            os.utime(os.path.join(restore_dir, "touched.txt"), ns=(0, 0))
+            with open(os.path.join(restore_dir, "edited.txt"), "wb") as f:
+                f.write(b"EDITED")
+            os.unlink(os.path.join(restore_dir, "removed.txt"))
+            with open(os.path.join(restore_dir, "dir", "big.bin"), "r+b") as f:
+                f.write(b"x")
+            os.unlink(os.path.join(restore_dir, "dir", "replaced"))
+            os.makedirs(os.path.join(restore_dir, "dir", "replaced", "sub"))
+            os.makedirs(os.path.join(restore_dir, "extra_dir"))
+            open(os.path.join(restore_dir, "extra_dir", "file"), "w").close()
+            open(os.path.join(restore_dir, "dir", "extra.txt"), "w").close()
+
+            with unittest.mock.patch.object(BackupTool, "_queue_blob", autospec=True,
+                                            side_effect=BackupTool._queue_blob) as queue_blob:
+                tool.restore(1, restore_dir, incremental=True, delete=True)
+            tool.close()
+            written = sorted(os.path.relpath(call.args[5], restore_dir) for call in queue_blob.call_args_list)
+            self.assertEqual(written, sorted(["edited.txt", "removed.txt", os.path.join("dir", "big.bin"),
+                                              os.path.join("dir", "replaced")]))
+            restored = [os.path.relpath(os.path.join(dir_path, name), restore_dir)
+                        for dir_path, _, names in os.walk(restore_dir) for name in names]
+            self.assertEqual(sorted(restored), sorted(contents))
+            for name in contents:
+                self.assertTrue(filecmp.cmp(os.path.join(tmp_src, name), os.path.join(restore_dir, name),
+                                            shallow=False))
+            self.assertEqual(os.stat(os.path.join(restore_dir, "touched.txt")).st_mtime_ns,
+                             os.stat(os.path.join(tmp_src, "touched.txt")).st_mtime_ns)
+
+            # A file or a symlink where the snapshot has a directory is replaced without
+            # --delete, and nothing is written through the symlink.
+            outside = os.path.join(tmp_dst, "outside")
+            os.makedirs(outside)
+            with open(os.path.join(outside, "big.bin"), "wb") as f:
+                f.write(b"outside")
+            for make_dir in [lambda path: open(path, "w").close(), lambda path: os.symlink(outside, path)]:
+                shutil.rmtree(os.path.join(restore_dir, "dir"))
+                make_dir(os.path.join(restore_dir, "dir"))
+                tool = BackupTool(tmp_db.name)
+                tool.restore(1, restore_dir, incremental=True)
+                tool.close()
+                self.assertFalse(os.path.islink(os.path.join(restore_dir, "dir")))
+                for name in contents:
+                    self.assertTrue(filecmp.cmp(os.path.join(tmp_src, name), os.path.join(restore_dir, name),
+                                                shallow=False))
+            self.assertEqual(os.listdir(outside), ["big.bin"])
+            with open(os.path.join(outside, "big.bin"), "rb") as f:
+                self.assertEqual(f.read(), b"outside")
+
+    def test_dedup_restore(self):
+        # With dedup, each blob is written once and the other paths with it are
+        # created from that file; reflinks fall back to copies where unsupported.
+        with tempfile.TemporaryDirectory() as tmp_src, tempfile.TemporaryDirectory() as tmp_dst, tempfile.NamedTemporaryFile(delete=False) as tmp_db:
+            names = [os.path.join(f"dir{i % 2}", f"copy{i}.bin") for i in range(4)] + ["big.bin", "unique.bin"]
+            shared = os.urandom(5000)
+            for name in names:
+                os.makedirs(os.path.join(tmp_src, os.path.dirname(name)), exist_ok=True)
+                with open(os.path.join(tmp_src, name), "wb") as f:
+                    f.write(shared if name.startswith("dir") else os.urandom(8000))
+            shutil.copyfile(os.path.join(tmp_src, "big.bin"), os.path.join(tmp_src, "dir1", "big_copy.bin"))
+            names.append(os.path.join("dir1", "big_copy.bin"))
+            tool = BackupTool(tmp_db.name)
+            self.addCleanup(shutil.rmtree, tmp_db.name + ".store", True)
+            with unittest.mock.patch.object(sys.modules[__name__], "CHUNK_SIZE", 3000):
+                tool.snapshot(tmp_src)
+            inodes = {}
+            for mode in ["hardlink", "copy", "reflink"]:
+                restore_dir = os.path.join(tmp_dst, mode)
+                with unittest.mock.patch.object(BackupTool, "_queue_blob", autospec=True,
+                                                side_effect=BackupTool._queue_blob) as queue_blob:
+                    tool.restore(1, restore_dir, dedup=mode)
+                self.assertEqual(queue_blob.call_count, 3)
+                for name in names:
+                    self.assertTrue(filecmp.cmp(os.path.join(tmp_src, name), os.path.join(restore_dir, name),
+                                                shallow=False))
+                    if mode == "copy":
+                        self.assertEqual(os.stat(os.path.join(restore_dir, name)).st_mtime_ns,
+                                         os.stat(os.path.join(tmp_src, name)).st_mtime_ns)
+                inodes[mode] = {os.stat(os.path.join(restore_dir, name)).st_ino for name in names}
+            tool.close()
+            self.assertEqual(len(inodes["hardlink"]), 3)
+            self.assertEqual(len(inodes["copy"]), len(names))
+            self.assertEqual(len(inodes["reflink"]), len(names))
+
+    def test_batched_commits(self):
+        # Small batches commit part-way through a snapshot; a failed snapshot leaves
+        # no snapshot or file rows behind.
+        with tempfile.TemporaryDirectory() as tmp_src, tempfile.NamedTemporaryFile(delete=False) as tmp_db:
+            for i in range(10):
+                with open(os.path.join(tmp_src, f"file{i}.txt"), "w") as f:
+                    f.write(f"content {i % 3}")
+            tool = BackupTool(tmp_db.name)
+            tool.snapshot(tmp_src, commit_rows=2)
+            cur = tool.conn.cursor()
+            cur.execute("SELECT COUNT(*), COUNT(DISTINCT blob_hash) FROM files")
+            self.assertEqual(cur.fetchone(), (10, 3))
+            cur.execute("SELECT COUNT(*) FROM blobs")
+            self.assertEqual(cur.fetchone()[0], 3)
+
+            original_write = _SnapshotWriter.write
+            calls = []
+
+            def failing_write(writer, msg):
+                calls.append(msg)
+                if len(calls) == 8:
+                    raise RuntimeError("simulated failure")
+                original_write(writer, msg)
+
+            with unittest.mock.patch.object(_SnapshotWriter, "write", failing_write):
+                with self.assertRaises(RuntimeError):
+                    tool.snapshot(tmp_src, rehash=True, commit_rows=2)
+            cur.execute("SELECT COUNT(*) FROM snapshots")
+            self.assertEqual(cur.fetchone()[0], 1)
+            cur.execute("SELECT COUNT(*) FROM files")
+            self.assertEqual(cur.fetchone()[0], 10)
+            tool.close()
+
+    def test_interrupted_snapshot_is_ignored(self):
+        # A snapshot that dies after committing some batches, without abort()
+        # cleaning up, is not listed, restored, pruned or used as the previous one.
+        with tempfile.TemporaryDirectory() as tmp_src, tempfile.TemporaryDirectory() as restore_dir, \
+                tempfile.NamedTemporaryFile(delete=False) as tmp_db:
+            for i in range(10):
+                with open(os.path.join(tmp_src, f"file{i}.txt"), "w") as f:
+                    f.write(f"content {i}")
+            tool = BackupTool(tmp_db.name)
+            tool.snapshot(tmp_src)
+            original_write = _SnapshotWriter.write
+            calls = []
+
+            def failing_write(writer, msg):
+                calls.append(msg)
+                if len(calls) == 8:
+                    raise RuntimeError("simulated crash")
+                original_write(writer, msg)
+
+            with unittest.mock.patch.object(_SnapshotWriter, "write", failing_write), \
+                    unittest.mock.patch.object(_SnapshotWriter, "abort", lambda writer: None):
+                with self.assertRaises(RuntimeError):
+                    tool.snapshot(tmp_src, rehash=True, commit_rows=2)
+            cur = tool.conn.cursor()
+            cur.execute("SELECT id FROM snapshots WHERE NOT complete")
+            self.assertEqual(cur.fetchall(), [(2,)])
+            with unittest.mock.patch("sys.stdout", new_callable=io.StringIO) as out:
+                tool.list_snapshots()
+                tool.restore(2, restore_dir)
+            self.assertNotIn("\n2 ", out.getvalue())
+            self.assertIn("Snapshot 2 not found.", out.getvalue())
+            self.assertEqual(os.listdir(restore_dir), [])
+            tool.snapshot(tmp_src)
+            self.assertEqual(tool.stats["unchanged"], 10)
+            tool.prune(3)
+            cur.execute("SELECT id FROM snapshots")
+            self.assertEqual(cur.fetchall(), [(2,)])
+            tool.close()
+
+    def test_known_hash_bloom_filter(self):
+        # With the exact-set limit forced to zero, dedup goes through the Bloom filter
+        # and still stores each distinct blob exactly once.
+        with tempfile.TemporaryDirectory() as tmp_src, tempfile.NamedTemporaryFile(delete=False) as tmp_db:
+            for i in range(20):
+                with open(os.path.join(tmp_src, f"file{i}.txt"), "w") as f:
+                    f.write(f"content {i % 4}")
+            tool = BackupTool(tmp_db.name)
+            with unittest.mock.patch.object(sys.modules[__name__], "KNOWN_SET_LIMIT", 0):
+                tool.snapshot(tmp_src)
+                tool.snapshot(tmp_src, rehash=True)
+                known = _KnownHashes.load(tool.conn)
+            self.assertIsNone(known.exact)
+            cur = tool.conn.cursor()
+            cur.execute("SELECT hash FROM blobs")
+            hashes = [row[0] for row in cur.fetchall()]
+            self.assertEqual(len(hashes), 4)
+            self.assertTrue(all(h in known for h in hashes))
+            self.assertNotIn(hashlib.sha256(b"absent").digest(), known)
+            tool.close()
+
+    def test_walk_skips_directory_symlinks(self):
+        # The scandir walker descends into nested directories, follows symlinks to
+        # files, and does not descend through symlinks to directories.
+        with tempfile.TemporaryDirectory() as tmp_src, tempfile.NamedTemporaryFile(delete=False) as tmp_db:
+            nested = os.path.join(tmp_src, "a", "b", "c")
+            os.makedirs(nested)
+            with open(os.path.join(nested, "deep.txt"), "w") as f:
+                f.write("deep")
+            os.symlink(os.path.join(nested, "deep.txt"), os.path.join(tmp_src, "link.txt"))
+            os.symlink(os.path.join(tmp_src, "a"), os.path.join(tmp_src, "dirlink"))
+            tool = BackupTool(tmp_db.name)
+            tool.snapshot(tmp_src, jobs=3)
+            cur = tool.conn.cursor()
+            cur.execute("SELECT path FROM files ORDER BY path")
+            paths = [row[0] for row in cur.fetchall()]
+            tool.close()
+            self.assertEqual(paths, [os.path.join("a", "b", "c", "deep.txt"), "link.txt"])
+
+    def test_include_exclude_rules(self):
+        # The first matching rule decides, and excluded directories are never listed.
+        with tempfile.TemporaryDirectory() as tmp_src, tempfile.NamedTemporaryFile(delete=False) as tmp_db:
+            for rel_path in ["src/main.py", "src/node_modules/lib.js", "node_modules/x.js",
+                             "build/out.o", "src/build.py", "a.tmp", "keep.tmp"]:
+                path = os.path.join(tmp_src, rel_path)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, "w") as f:
+                    f.write(rel_path)
+            path_filter = PathFilter([("exclude", "node_modules/"), ("include", "keep.tmp"),
+                                      ("exclude", "*.tmp"), ("exclude", "/build")])
+            tool = BackupTool(tmp_db.name)
+            with unittest.mock.patch("os.scandir", wraps=os.scandir) as scandir:
+                tool.snapshot(tmp_src, path_filter=path_filter)
+            scanned = [call.args[0] for call in scandir.call_args_list]
+            cur = tool.conn.cursor()
+            cur.execute("SELECT path FROM files ORDER BY path")
+            paths = [row[0] for row in cur.fetchall()]
+            tool.close()
+            self.assertEqual(paths, ["keep.tmp", "src/build.py", "src/main.py"])
+            self.assertFalse([d for d in scanned if "node_modules" in d or d.endswith("build")])
+
+    def test_hardlinks_read_once(self):
+        # All links to one inode are read once, and can be restored as hard links.
+        with tempfile.TemporaryDirectory() as tmp_src, tempfile.TemporaryDirectory() as tmp_dst, tempfile.NamedTemporaryFile(delete=False) as tmp_db:
+            first = os.path.join(tmp_src, "first.txt")
+            with open(first, "w") as f:
+                f.write("linked")
+            os.makedirs(os.path.join(tmp_src, "sub"))
+            for name in ["second.txt", os.path.join("sub", "third.txt")]:
+                os.link(first, os.path.join(tmp_src, name))
+            tool = BackupTool(tmp_db.name)
+            tool.snapshot(tmp_src, jobs=3)
+            self.assertEqual((tool.stats["read"], tool.stats["hardlink"]), (1, 2))
+            restore_dir = os.path.join(tmp_dst, "restore")
+            tool.restore(1, restore_dir, hardlinks=True)
+            tool.close()
+            inodes = {os.stat(os.path.join(restore_dir, name)).st_ino
+                      for name in ["first.txt", "second.txt", os.path.join("sub", "third.txt")]}
+            self.assertEqual(len(inodes), 1)
+            with open(os.path.join(restore_dir, "sub", "third.txt")) as f:
+                self.assertEqual(f.read(), "linked")
+
+    def test_compression(self):
+        # Compressible content is stored compressed with its codec recorded, random
+        # content is stored raw, and restore decompresses transparently.
+        for codec in sorted(CODECS):
+            with tempfile.TemporaryDirectory() as tmp_src, tempfile.TemporaryDirectory() as tmp_dst, tempfile.NamedTemporaryFile(delete=False) as tmp_db:
+                text = os.path.join(tmp_src, "text.txt")
+                with open(text, "w") as f:
+                    f.write("all work and no play makes jack a dull boy\n" * 2000)
+                noise = os.path.join(tmp_src, "noise.bin")
+                with open(noise, "wb") as f:
+                    f.write(os.urandom(20000))
+                tool = BackupTool(tmp_db.name)
+                tool.snapshot(tmp_src, compression=codec)
+                cur = tool.conn.cursor()
+                cur.execute("SELECT size, codec FROM blobs ORDER BY size")
+                self.assertEqual(cur.fetchall(), [(20000, None), (86000, codec)])
+                self.assertLess(tool.stats["stored_bytes"], 30000)
+                restore_dir = os.path.join(tmp_dst, "restore")
+                tool.restore(1, restore_dir)
+                tool.close()
+                for path in [text, noise]:
+                    self.assertTrue(filecmp.cmp(path, os.path.join(restore_dir, os.path.basename(path)),
+                                                shallow=False))
+
+    def test_migrate_v1_database(self):
+        # A v1 database (hex TEXT keys, full paths in files) stays usable before
+        # migrate, including a new snapshot that repeats old content, and migrate
+        # converts every key to binary and every snapshot to trees.
+        with tempfile.TemporaryDirectory() as tmp_src, tempfile.TemporaryDirectory() as tmp_dst, tempfile.NamedTemporaryFile(delete=False) as tmp_db:
+            big = os.path.join(tmp_src, "big.bin")
+            with open(big, "wb") as f:
+                f.write(os.urandom(200000))
+            os.makedirs(os.path.join(tmp_src, "sub"))
+            small = os.path.join(tmp_src, "sub", "small.txt")
+            with open(small, "w") as f:
+                f.write("small")
+            conn = sqlite3.connect(tmp_db.name)
+            conn.execute("CREATE TABLE files (snapshot_id INTEGER, path TEXT, blob_hash TEXT, "
+                         "PRIMARY KEY (snapshot_id, path))")
+            conn.close()
+            chunker = FastCDC(min_size=4096, avg_size=16384, max_size=65536, min_file_size=0)
+            tool = BackupTool(tmp_db.name)
+            self.assertEqual(tool.schema_version, 1)
+            self.assertFalse(tool.normalized)
+            tool.snapshot(tmp_src, chunker=chunker)
+            for table, column in [("blobs", "hash"), ("files", "blob_hash"),
+                                  ("chunks", "blob_hash"), ("chunks", "chunk_hash")]:
+                tool.conn.execute(f"UPDATE {table} SET {column} = lower(hex({column}))")
+            tool.conn.commit()
+            tool.close()
+
+            tool = BackupTool(tmp_db.name)
+            with open(os.path.join(tmp_src, "new.txt"), "w") as f:
+                f.write("new")
+            tool.snapshot(tmp_src, chunker=chunker, rehash=True)
+            tool.restore(1, os.path.join(tmp_dst, "before"))
+            tool.migrate(batch_size=3)
+            self.assertEqual(tool.schema_version, SCHEMA_VERSION)
+            self.assertTrue(tool.normalized)
+            cur = tool.conn.cursor()
+            cur.execute("PRAGMA user_version")
+            self.assertEqual(cur.fetchone()[0], SCHEMA_VERSION)
+            cur.execute(
+                "SELECT (SELECT COUNT(*) FROM blobs WHERE typeof(hash) <> 'blob') + "
+                "(SELECT COUNT(*) FROM files WHERE typeof(blob_hash) <> 'blob') + "
+                "(SELECT COUNT(*) FROM chunks WHERE typeof(blob_hash) <> 'blob' OR typeof(chunk_hash) <> 'blob')"
+            )
+            self.assertEqual(cur.fetchone()[0], 0)
+            cur.execute("SELECT (SELECT COUNT(*) FROM snapshots WHERE root_tree IS NULL), "
+                        "(SELECT COUNT(*) FROM entries), (SELECT COUNT(*) FROM paths), (SELECT COUNT(*) FROM dirs)")
+            self.assertEqual(cur.fetchone(), (0, 0, 0, 0))
+            cur.execute("SELECT COUNT(*), COUNT(DISTINCT hash) FROM blobs")
+            count, distinct = cur.fetchone()
+            self.assertEqual(count, distinct)
+            cur.execute("SELECT snapshot_id, path FROM files ORDER BY snapshot_id, path")
+            self.assertEqual(cur.fetchall(), [(1, "big.bin"), (1, "sub/small.txt"),
+                                              (2, "big.bin"), (2, "new.txt"), (2, "sub/small.txt")])
+            tool.prune(1)
+            tool.restore(2, os.path.join(tmp_dst, "after"))
+            # The first snapshot after migrating finds unchanged files in the converted trees.
+            tool.snapshot(tmp_src, chunker=chunker)
+            self.assertEqual(tool.stats["unchanged"], 3)
+            tool.close()
+            for name in ["before", "after"]:
+                for path in [big, small]:
+                    rel_path = os.path.relpath(path, tmp_src)
+                    self.assertTrue(filecmp.cmp(path, os.path.join(tmp_dst, name, rel_path), shallow=False))
+
+    def test_tree_objects(self):
+        # Unchanged directories reuse the trees of the previous snapshot, a change
+        # writes new trees only along its path, and prune drops unreachable trees.
+        with tempfile.TemporaryDirectory() as tmp_src, tempfile.TemporaryDirectory() as tmp_dst, tempfile.NamedTemporaryFile(delete=False) as tmp_db:
+            for rel_dir in ["", "a", os.path.join("a", "b"), "c"]:
+                os.makedirs(os.path.join(tmp_src, rel_dir), exist_ok=True)
+                for i in range(3):
+                    with open(os.path.join(tmp_src, rel_dir, f"file{i}.txt"), "w") as f:
+                        f.write(f"{rel_dir} {i}")
+            tool = BackupTool(tmp_db.name)
+            tool.snapshot(tmp_src)
+            cur = tool.conn.cursor()
+
+            def counts():
+                cur.execute("SELECT (SELECT COUNT(*) FROM trees), (SELECT COUNT(*) FROM tree_entries)")
+                return cur.fetchone()
+
+            self.assertEqual(counts(), (4, 15))
+            tool.snapshot(tmp_src)
+            self.assertEqual((tool.stats["unchanged"], tool.stats["dirs"], tool.stats["new_trees"]), (12, 4, 0))
+            self.assertEqual(counts(), (4, 15))
+            cur.execute("SELECT path FROM files WHERE snapshot_id = 2 ORDER BY path")
+            self.assertEqual([row[0] for row in cur.fetchall()],
+                             [f"{d}file{i}.txt" for d in ["a/b/", "a/", "c/", ""] for i in range(3)])
+
+            with open(os.path.join(tmp_src, "a", "b", "file0.txt"), "w") as f:
+                f.write("changed")
+            tool.snapshot(tmp_src)
+            self.assertEqual(tool.stats["new_trees"], 3)
+            self.assertEqual(counts(), (7, 27))
+
+            shutil.rmtree(os.path.join(tmp_src, "a", "b"))
+            tool.snapshot(tmp_src)
+            tool.prune(3)
+            self.assertEqual(counts(), (3, 11))
+            restore_dir = os.path.join(tmp_dst, "restore")
+            tool.restore(4, restore_dir)
+            tool.close()
+            self.assertFalse(os.path.exists(os.path.join(restore_dir, "a", "b")))
+            for rel_path in ["file1.txt", os.path.join("a", "file2.txt"), os.path.join("c", "file0.txt")]:
+                self.assertTrue(filecmp.cmp(os.path.join(tmp_src, rel_path), os.path.join(restore_dir, rel_path),
+                                            shallow=False))
+
+    def test_migrate_entries_to_trees(self):
+        # Entries converted by migrate give the same trees as a snapshot taken
+        # directly, and only the directories on the current path are held open.
+        with tempfile.TemporaryDirectory() as tmp_src, tempfile.NamedTemporaryFile(delete=False) as tmp_db:
+            for rel_dir in ["", "a", "a-c", os.path.join("a", "b"), os.path.join("a", "b", "c"),
+                            os.path.join("x", "y", "z")]:
+                os.makedirs(os.path.join(tmp_src, rel_dir), exist_ok=True)
+                for i in range(2):
+                    with open(os.path.join(tmp_src, rel_dir, f"file{i}.txt"), "w") as f:
+                        f.write(f"{rel_dir} {i}")
+            tool = BackupTool(tmp_db.name)
+            tool.snapshot(tmp_src)
+            cur = tool.conn.cursor()
+            cur.execute("INSERT INTO snapshots (id, timestamp) VALUES (2, 'migrated')")
+            cur.execute("SELECT path, blob_hash, dev, ino, size, mtime_ns, ctime_ns FROM files "
+                        "WHERE snapshot_id = 1")
+            paths = _PathIndex(tool.conn)
+            for path, *entry in cur.fetchall():
+                tool.conn.execute("INSERT INTO entries (snapshot_id, path_id, blob_hash, dev, ino, size, "
+                                  "mtime_ns, ctime_ns) VALUES (2, ?, ?, ?, ?, ?, ?, ?)",
+                                  [paths.intern(path)] + entry)
+            tool.conn.commit()
+
+            open_dirs = []
+            add = _TreeBuilder.add
+
+            def tracked_add(builder, rel_path, entry):
+                open_dirs.append(len(builder.pending))
+                add(builder, rel_path, entry)
+
+            with unittest.mock.patch.object(_TreeBuilder, "add", tracked_add):
+                self.assertEqual(tool._migrate_entries_to_trees(batch_size=3), 1)
+            self.assertLessEqual(max(open_dirs), 4)
+            cur.execute("SELECT root_tree FROM snapshots ORDER BY id")
+            roots = [row[0] for row in cur.fetchall()]
+            tool.close()
+            self.assertEqual(roots[0], roots[1])
+
+    def test_pack_storage(self):
+        # Content goes to size-capped pack files with only its location in the
+        # database, restore reads it back, and prune deletes packs no longer used.
+        with tempfile.TemporaryDirectory() as tmp_src, tempfile.TemporaryDirectory() as tmp_dst, tempfile.NamedTemporaryFile(delete=False) as tmp_db:
+            for i in range(4):
+                with open(os.path.join(tmp_src, f"file{i}.bin"), "wb") as f:
+                    f.write(os.urandom(3000))
+            with open(os.path.join(tmp_src, "text.txt"), "w") as f:
+                f.write("pack me " * 1000)
+            tool = BackupTool(tmp_db.name)
+            self.addCleanup(shutil.rmtree, tmp_db.name + ".store", True)
+            tool.snapshot(tmp_src, storage="pack", pack_size=5000, compression="zlib", inline_threshold=0)
+            cur = tool.conn.cursor()
+            cur.execute("SELECT COUNT(*) FROM blobs WHERE content IS NULL AND pack_id IS NOT NULL")
+            self.assertEqual(cur.fetchone()[0], 5)
+            self.assertEqual(len(_pack_ids(tool.packs_dir)), 4)
+            for pack_id in _pack_ids(tool.packs_dir):
+                self.assertLessEqual(os.path.getsize(_pack_path(tool.packs_dir, pack_id)), 6000)
+
+            restore_dir = os.path.join(tmp_dst, "restore")
+            tool.restore(1, restore_dir)
+            self.assertFalse(filecmp.dircmp(tmp_src, restore_dir).diff_files)
+
+            for i in range(4):
+                os.remove(os.path.join(tmp_src, f"file{i}.bin"))
+            tool.snapshot(tmp_src, storage="pack", pack_size=5000, inline_threshold=0)
+            tool.prune(1)
+            tool.restore(2, os.path.join(tmp_dst, "restore2"))
+            cur.execute("SELECT pack_id FROM blobs")
+            self.assertEqual(set(_pack_ids(tool.packs_dir)), {cur.fetchone()[0], 4})
+            tool.close()
+            self.assertTrue(filecmp.cmp(os.path.join(tmp_src, "text.txt"),
+                                        os.path.join(tmp_dst, "restore2", "text.txt"), shallow=False))
+
+    def test_prune_waits_for_snapshots(self):
+        # A snapshot holds the repository lock until it is done, so prune cannot
+        # remove blobs it reuses but has not referenced yet.
+        with tempfile.TemporaryDirectory() as tmp_src, tempfile.NamedTemporaryFile(delete=False) as tmp_db:
+            with open(os.path.join(tmp_src, "file.txt"), "w") as f:
+                f.write("content")
+            tool = BackupTool(tmp_db.name)
+            self.addCleanup(shutil.rmtree, tmp_db.name + ".store", True)
+            tool.snapshot(tmp_src)
+            running = tool._lock_repository(shared=True)
+            tool.close()
+
+            def prune():
+                pruning = BackupTool(tmp_db.name)
+                pruning.prune(1)
+                pruning.close()
+
+            pruner = threading.Thread(target=prune)
+            pruner.start()
+            pruner.join(0.2)
+            self.assertTrue(pruner.is_alive())
+            running.close()
+            pruner.join()
+            tool = BackupTool(tmp_db.name)
+            cur = tool.conn.cursor()
+            cur.execute("SELECT COUNT(*) FROM snapshots")
+            self.assertEqual(cur.fetchone()[0], 0)
+            tool.close()
+
+    def test_prune_waits_for_pack_lock(self):
+        # Prune deletes unused packs only once no snapshot holds the pack lock.
+        with tempfile.TemporaryDirectory() as tmp_src, tempfile.NamedTemporaryFile(delete=False) as tmp_db:
+            tool = BackupTool(tmp_db.name)
+            self.addCleanup(shutil.rmtree, tmp_db.name + ".store", True)
+            for version in range(2):
+                for i in range(4):
+                    with open(os.path.join(tmp_src, f"file{i}.bin"), "wb") as f:
+                        f.write(os.urandom(3000))
+                tool.snapshot(tmp_src, storage="pack", inline_threshold=0, pack_size=4096)
+            tool.close()
+            first_pack = _pack_path(tool.packs_dir, 1)
+            lock = _lock_file(os.path.join(tool.packs_dir, "lock"))
+
+            def prune():
+                pruning = BackupTool(tmp_db.name)
+                pruning.prune(1)
+                pruning.close()
+
+            pruner = threading.Thread(target=prune)
+            pruner.start()
+            pruner.join(0.2)
+            self.assertTrue(pruner.is_alive())
+            self.assertTrue(os.path.exists(first_pack))
+            lock.close()
+            pruner.join()
+            self.assertFalse(os.path.exists(first_pack))
+
+    def test_concurrent_pack_writers(self):
+        # Two snapshots taken at once into the same packs do not interleave their
+        # appends: the second waits for the first's pack lock.
+        with tempfile.TemporaryDirectory() as tmp_src, tempfile.TemporaryDirectory() as tmp_dst, tempfile.NamedTemporaryFile(delete=False) as tmp_db:
+            for tree in ["a", "b"]:
+                os.makedirs(os.path.join(tmp_src, tree))
+                for i in range(60):
+                    with open(os.path.join(tmp_src, tree, f"{tree}{i}.bin"), "wb") as f:
+                        f.write(os.urandom(2000 + i))
+            BackupTool(tmp_db.name).close()
+            self.addCleanup(shutil.rmtree, tmp_db.name + ".store", True)
+            errors = []
+
+            def take(tree):
+                try:
+                    tool = BackupTool(tmp_db.name)
+                    tool.snapshot(os.path.join(tmp_src, tree), storage="pack", inline_threshold=0,
+                                  commit_rows=5, jobs=2)
+                    tool.close()
+                except Exception as e:
+                    errors.append(e)
+
+            threads = [threading.Thread(target=take, args=(tree,)) for tree in ["a", "b"]]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertEqual(errors, [])
+            tool = BackupTool(tmp_db.name)
+            cur = tool.conn.cursor()
+            cur.execute("SELECT id FROM snapshots ORDER BY id")
+            snapshot_ids = [row[0] for row in cur.fetchall()]
+            self.assertEqual(len(snapshot_ids), 2)
+            for snapshot_id in snapshot_ids:
+                tool.restore(snapshot_id, os.path.join(tmp_dst, str(snapshot_id)))
+            tool.close()
+            for tree in ["a", "b"]:
+                names = sorted(os.listdir(os.path.join(tmp_src, tree)))
+                matching = [snapshot_id for snapshot_id in snapshot_ids
+                            if sorted(os.listdir(os.path.join(tmp_dst, str(snapshot_id)))) == names]
+                self.assertEqual(len(matching), 1)
+                for name in names:
+                    self.assertTrue(filecmp.cmp(os.path.join(tmp_src, tree, name),
+                                                os.path.join(tmp_dst, str(matching[0]), name), shallow=False))
+
+    def test_hybrid_placement(self):
+        # Stored blobs below the inline threshold stay in the database and larger ones
+        # become object files; a file whose pieces are placed both ways restores
+        # intact, and prune removes object files along with their rows.
+        with tempfile.TemporaryDirectory() as tmp_src, tempfile.TemporaryDirectory() as tmp_dst, tempfile.NamedTemporaryFile(delete=False) as tmp_db:
+            with open(os.path.join(tmp_src, "small.cfg"), "w") as f:
+                f.write("key = value\n")
+            with open(os.path.join(tmp_src, "image.bin"), "wb") as f:
+                for i in range(40):
+                    f.write(os.urandom(3000) if i % 2 else bytes([i]) * 3000)
+            tool = BackupTool(tmp_db.name)
+            self.addCleanup(shutil.rmtree, tmp_db.name + ".store", True)
+            with unittest.mock.patch.object(sys.modules[__name__], "CHUNK_SIZE", 3000):
+                tool.snapshot(tmp_src, storage="object", inline_threshold=1000, compression="zlib")
+            cur = tool.conn.cursor()
+            cur.execute("SELECT placement, COUNT(*) FROM blobs GROUP BY placement ORDER BY placement")
+            self.assertEqual(cur.fetchall(), [("inline", 21), ("object", 20), ("pieces", 1)])
+            cur.execute("SELECT hash FROM blobs WHERE placement = 'object'")
+            objects = [_object_path(tool.objects_dir, row[0]) for row in cur.fetchall()]
+            self.assertTrue(all(os.path.getsize(path) == 3000 for path in objects))
+
+            restore_dir = os.path.join(tmp_dst, "restore")
+            tool.restore(1, restore_dir)
+            for name in ["small.cfg", "image.bin"]:
+                self.assertTrue(filecmp.cmp(os.path.join(tmp_src, name), os.path.join(restore_dir, name),
+                                            shallow=False))
+
+            os.remove(os.path.join(tmp_src, "image.bin"))
+            tool.snapshot(tmp_src)
+            tool.prune(1)
+            tool.close()
+            self.assertFalse(any(os.path.exists(path) for path in objects))
+
+    def test_delta_encoding(self):
+        # A changed file is stored as a delta against its previous version, chains are
+        # cut at MAX_DELTA_DEPTH, every version restores intact, and prune keeps the
+        # bases of remaining deltas.
+        base = os.urandom(100000)
+        edited = base[:500] + b"edit" + base[600:70000] + os.urandom(3000) + base[70000:]
+        self.assertEqual(_apply_delta(base, _make_delta(base, edited, 50000)), edited)
+        # A target unrelated to its base is rejected by sampling, before the full scan.
+        index = {base[i:i + DELTA_BLOCK]: i for i in range(0, len(base) - DELTA_BLOCK + 1, DELTA_BLOCK)}
+        self.assertTrue(_delta_sample_matches(index, edited, 50000))
+        self.assertFalse(_delta_sample_matches(index, os.urandom(100000), 50000))
+        self.assertIsNone(_make_delta(base, os.urandom(100000), 50000))
+
+        with tempfile.TemporaryDirectory() as tmp_src, tempfile.TemporaryDirectory() as tmp_dst, tempfile.NamedTemporaryFile(delete=False) as tmp_db:
+            log = os.path.join(tmp_src, "app.log")
+            lines = [os.urandom(20).hex() + "\n" for _ in range(2000)]
+            tool = BackupTool(tmp_db.name)
+            self.addCleanup(shutil.rmtree, tmp_db.name + ".store", True)
+            versions = []
+            with unittest.mock.patch.object(sys.modules[__name__], "MAX_DELTA_DEPTH", 2):
+                for version in range(4):
+                    lines[version * 100] = "changed\n"
+                    lines += [os.urandom(20).hex() + "\n" for _ in range(10)]
+                    versions.append("".join(lines))
+                    with open(log, "w") as f:
+                        f.write(versions[-1])
+                    tool.snapshot(tmp_src, compression="zlib", storage="pack", inline_threshold=1000, delta=True)
+            cur = tool.conn.cursor()
+            # Full versions go to the pack; the small deltas stay inline.
+            cur.execute("SELECT delta_depth, placement FROM blobs ORDER BY rowid")
+            self.assertEqual(cur.fetchall(), [(None, "pack"), (1, "inline"), (2, "inline"), (None, "pack")])
+
+            for snapshot_id, content in enumerate(versions, 1):
+                restore_dir = os.path.join(tmp_dst, str(snapshot_id))
+                tool.restore(snapshot_id, restore_dir)
+                with open(os.path.join(restore_dir, "app.log")) as f:
+                    self.assertEqual(f.read(), content)
+
+            tool.prune(2)
+            cur.execute("SELECT COUNT(*) FROM blobs")
+            self.assertEqual(cur.fetchone()[0], 4)
+            tool.prune(3)
+            cur.execute("SELECT COUNT(*) FROM blobs")
+            self.assertEqual(cur.fetchone()[0], 1)
+            restore_dir = os.path.join(tmp_dst, "last")
+            tool.restore(4, restore_dir)
+            tool.close()
+            with open(os.path.join(restore_dir, "app.log")) as f:
+                self.assertEqual(f.read(), versions[-1])
+
+    def test_delta_of_content_known_meanwhile(self):
+        # Content the writer receives from another file between storing the full
+        # version and the delta is still recorded for the changed file.
+        with tempfile.TemporaryDirectory() as tmp_src, tempfile.TemporaryDirectory() as tmp_dst, tempfile.NamedTemporaryFile(delete=False) as tmp_db:
+            log = os.path.join(tmp_src, "app.log")
+            lines = [os.urandom(20).hex() + "\n" for _ in range(2000)]
+            with open(log, "w") as f:
+                f.write("".join(lines))
+            tool = BackupTool(tmp_db.name)
+            tool.snapshot(tmp_src, delta=True, jobs=1)
+            lines[0] = "changed\n"
+            with open(log, "w") as f:
+                f.write("".join(lines))
+            answers = iter([False, True])
+            with unittest.mock.patch.object(_KnownHashes, "definitely_contains",
+                                            side_effect=lambda digest: next(answers, False)):
+                tool.snapshot(tmp_src, delta=True, jobs=1)
+            cur = tool.conn.cursor()
+            cur.execute("SELECT COUNT(*) FROM files WHERE snapshot_id = 2")
+            self.assertEqual(cur.fetchone()[0], 1)
+            restore_dir = os.path.join(tmp_dst, "restore")
+            tool.restore(2, restore_dir)
+            tool.close()
+            self.assertTrue(filecmp.cmp(log, os.path.join(restore_dir, "app.log"), shallow=False))
+
+    def test_sharded_repository(self):
+        # Blobs and piece lists are written to the shard their digest selects, the
+        # catalog keeps none, and restore and prune work across shards. The layout
+        # persists when the repository is reopened.
+        with tempfile.TemporaryDirectory() as tmp_src, tempfile.TemporaryDirectory() as tmp_dst, tempfile.NamedTemporaryFile(delete=False) as tmp_db:
+            for i in range(20):
+                with open(os.path.join(tmp_src, f"file{i}.txt"), "w") as f:
+                    f.write(f"content {i}\n")
+            with open(os.path.join(tmp_src, "big.bin"), "wb") as f:
+                f.write(os.urandom(10000))
+            tool = BackupTool(tmp_db.name, shards=4)
+            self.addCleanup(shutil.rmtree, tmp_db.name + ".store", True)
+            with unittest.mock.patch.object(sys.modules[__name__], "CHUNK_SIZE", 3000):
+                tool.snapshot(tmp_src)
+            cur = tool.conn.cursor()
+            cur.execute("SELECT COUNT(*) FROM main.sqlite_master WHERE name IN ('blobs', 'chunks')")
+            self.assertEqual(cur.fetchone()[0], 0)
+            counts = []
+            for index in range(4):
+                conn = sqlite3.connect(tool._shard_path(index))
+                hashes = [row[0] for row in conn.execute("SELECT hash FROM blobs")]
+                parents = [row[0] for row in conn.execute("SELECT DISTINCT blob_hash FROM chunks")]
+                conn.close()
+                self.assertTrue(all(_shard_index(h, 4) == index for h in hashes + parents))
+                counts.append(len(hashes))
+            self.assertEqual(sum(counts), 25)
+            self.assertGreater(sum(1 for count in counts if count), 1)
+
+            restore_dir = os.path.join(tmp_dst, "restore")
+            tool.restore(1, restore_dir)
+            self.assertTrue(filecmp.cmp(os.path.join(tmp_src, "big.bin"), os.path.join(restore_dir, "big.bin"),
+                                        shallow=False))
+            os.remove(os.path.join(tmp_src, "big.bin"))
+            tool.snapshot(tmp_src)
+            tool.prune(1)
+            tool.close()
+
+            tool = BackupTool(tmp_db.name)
+            self.assertEqual(tool.shard_count, 4)
+            cur = tool.conn.cursor()
+            cur.execute("SELECT (SELECT COUNT(*) FROM blobs), (SELECT COUNT(*) FROM chunks)")
+            self.assertEqual(cur.fetchone(), (20, 0))
+            tool.close()
+
+    def test_objects_repository(self):
+        # An objects repository stores all content as object files by default, keeps
+        # only metadata in the database, and remembers its format when reopened.
+        with tempfile.TemporaryDirectory() as tmp_src, tempfile.TemporaryDirectory() as tmp_dst, tempfile.NamedTemporaryFile(delete=False) as tmp_db:
+            with open(os.path.join(tmp_src, "small.txt"), "w") as f:
+                f.write("small")
+            open(os.path.join(tmp_src, "empty.txt"), "w").close()
+            with open(os.path.join(tmp_src, "big.bin"), "wb") as f:
+                f.write(os.urandom(10000))
+            tool = BackupTool(tmp_db.name, repo_format="objects")
+            self.addCleanup(shutil.rmtree, tmp_db.name + ".store", True)
+            # An object file without a row, as an interrupted snapshot leaves it, is
+            # replaced rather than trusted.
+            stale_path = _object_path(tool.objects_dir, hashlib.sha256(b"small").digest())
+            os.makedirs(os.path.dirname(stale_path))
+            with open(stale_path, "wb") as f:
+                f.write(zlib.compress(b"other content"))
+            with unittest.mock.patch.object(sys.modules[__name__], "CHUNK_SIZE", 3000):
+                tool.snapshot(tmp_src)
+            tool.close()
+
+            tool = BackupTool(tmp_db.name)
+            self.assertEqual(tool.repo_format, "objects")
+            cur = tool.conn.cursor()
+            cur.execute("SELECT placement, COUNT(*), COUNT(content) FROM blobs GROUP BY placement ORDER BY placement")
+            self.assertEqual(cur.fetchall(), [("object", 6, 0), ("pieces", 1, 0)])
+            restore_dir = os.path.join(tmp_dst, "restore")
+            tool.restore(1, restore_dir)
+            tool.close()
+            for name in ["small.txt", "empty.txt", "big.bin"]:
+                self.assertTrue(filecmp.cmp(os.path.join(tmp_src, name), os.path.join(restore_dir, name),
+                                            shallow=False))
+
+    def test_prune_uses_indexes(self):
+        # Prune removes the trees, blobs and pieces only the pruned snapshot used,
+        # keeps shared ones, and finds them all through indexes, without table scans.
+        with tempfile.TemporaryDirectory() as tmp_src, tempfile.TemporaryDirectory() as tmp_dst, tempfile.NamedTemporaryFile(delete=False) as tmp_db:
+            for rel_dir in ["a", os.path.join("a", "b"), "c"]:
+                os.makedirs(os.path.join(tmp_src, rel_dir), exist_ok=True)
+                with open(os.path.join(tmp_src, rel_dir, "file.txt"), "w") as f:
+                    f.write(rel_dir)
+            with open(os.path.join(tmp_src, "a", "b", "big.bin"), "wb") as f:
+                f.write(os.urandom(10000))
+            tool = BackupTool(tmp_db.name)
+            with unittest.mock.patch.object(sys.modules[__name__], "CHUNK_SIZE", 3000):
+                tool.snapshot(tmp_src)
+                os.remove(os.path.join(tmp_src, "a", "b", "big.bin"))
+                tool.snapshot(tmp_src)
+            cur = tool.conn.cursor()
+            statements = []
+            tool.conn.set_trace_callback(statements.append)
+            tool.prune(1)
+            tool.conn.set_trace_callback(None)
+            for statement in statements:
+                if statement.split()[0] in ("SELECT", "DELETE", "UPDATE"):
+                    cur.execute("EXPLAIN QUERY PLAN " + statement)
+                    scans = [row[3] for row in cur.fetchall()
+                             if row[3].startswith("SCAN") and row[3] != "SCAN sqlite_master"]
+                    self.assertEqual(scans, [], statement)
+            cur.execute("SELECT (SELECT COUNT(*) FROM trees), (SELECT COUNT(*) FROM blobs), "
+                        "(SELECT COUNT(*) FROM chunks)")
+            self.assertEqual(cur.fetchone(), (4, 3, 0))
+            restore_dir = os.path.join(tmp_dst, "restore")
+            tool.restore(2, restore_dir)
+            tool.close()
+            self.assertEqual(sorted(os.listdir(os.path.join(restore_dir, "a", "b"))), ["file.txt"])
+
     def test_prune(self):
         # Test that pruning a snapshot removes only the specified snapshots and
         # that remaining snapshots can be restored correctly.